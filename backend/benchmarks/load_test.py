@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test for the try-on backend.
+
+Starts server.py under uvicorn in a subprocess, pointed at:
+- a fake Gemini server (configurable latency and result image size), via GEMINI_BASE_URL
+- a fake n8n webhook receiver, via N8N_WEBHOOK_URL
+- a local MongoDB (a throwaway database that is dropped afterwards)
+
+Each virtual user session uploads a person and a clothing image, generates a try-on from the
+upload IDs, submits feedback and reads the feedback listing and analytics. Sessions run at the
+requested concurrency and the report shows throughput, latency percentiles per operation and
+the server's peak RSS.
+
+Usage:
+    python backend/benchmarks/load_test.py --sessions 200 --concurrency 16 --gemini-latency 2.0
+    python backend/benchmarks/load_test.py --json results.json
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from PIL import Image
+from pymongo import MongoClient
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+OPERATIONS = ["upload_person", "upload_clothing", "tryon", "feedback", "feedback_list", "feedback_analytics"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_jpeg(width: int, height: int, color: tuple) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def make_png(edge: int) -> bytes:
+    # Noise so the PNG is roughly as large as a real generated image
+    buffer = io.BytesIO()
+    Image.frombytes("RGB", (edge, edge), os.urandom(edge * edge * 3)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def create_fake_gemini_app(latency: float, jitter: float, result_image: bytes) -> FastAPI:
+    """
+    Answers the two Gemini REST calls the backend makes: model lookup (warm-up) and generateContent
+    """
+    fake_app = FastAPI()
+    result_b64 = base64.b64encode(result_image).decode("utf-8")
+    fake_app.state.calls = 0
+
+    @fake_app.get("/{api_version}/models/{model}")
+    async def get_model(api_version: str, model: str):
+        return {"name": f"models/{model}", "displayName": model}
+
+    @fake_app.post("/{api_version}/models/{model}:generateContent")
+    async def generate_content(api_version: str, model: str):
+        fake_app.state.calls += 1
+        await asyncio.sleep(max(0.0, random.gauss(latency, jitter)))
+        return {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"inlineData": {"mimeType": "image/png", "data": result_b64}}]},
+                "finishReason": "STOP"
+            }],
+            "modelVersion": model
+        }
+
+    return fake_app
+
+
+def create_fake_n8n_app() -> FastAPI:
+    fake_app = FastAPI()
+    fake_app.state.received = 0
+    fake_app.state.received_bytes = 0
+
+    @fake_app.post("/webhook")
+    async def receive(request: Request):
+        body = await request.body()
+        fake_app.state.received += 1
+        fake_app.state.received_bytes += len(body)
+        return {"ok": True}
+
+    return fake_app
+
+
+class ThreadedServer:
+    """
+    Runs a fake service under uvicorn on its own event loop, so it never competes with the load generator's loop
+    """
+
+    def __init__(self, app: FastAPI, port: int):
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_bytes(pid: int):
+    """
+    High-water mark of the server's resident set, read from /proc while it is still running (Linux)
+    """
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.latencies = {operation: [] for operation in OPERATIONS}
+        self.errors = {operation: 0 for operation in OPERATIONS}
+        self.error_samples = []
+        self.completed_sessions = 0
+
+    def prepare_images(self):
+        # Distinct colors per image so (person, clothing) pairs miss the result cache unless requested otherwise
+        pool_size = self.args.image_pool
+        width, height = self.args.input_width, self.args.input_height
+        self.person_images = [
+            make_jpeg(width, height, (random.randrange(256), random.randrange(256), random.randrange(256)))
+            for _ in range(pool_size)
+        ]
+        self.clothing_images = [
+            make_jpeg(width, height, (random.randrange(256), random.randrange(256), random.randrange(256)))
+            for _ in range(pool_size)
+        ]
+
+    async def timed(self, operation: str, call):
+        start = time.perf_counter()
+        try:
+            response = await call
+            response.raise_for_status()
+        except Exception as e:
+            self.errors[operation] += 1
+            if len(self.error_samples) < 10:
+                detail = e.response.text[:200] if isinstance(e, httpx.HTTPStatusError) else repr(e)
+                self.error_samples.append(f"{operation}: {detail}")
+            raise
+        self.latencies[operation].append(time.perf_counter() - start)
+        return response
+
+    async def run_session(self, http: httpx.AsyncClient, index: int):
+        pool_size = len(self.person_images)
+        person_image = self.person_images[index % pool_size]
+        clothing_image = self.clothing_images[(index // pool_size) % pool_size]
+
+        person = await self.timed("upload_person", http.post(
+            "/api/upload/person/binary", content=person_image, headers={"content-type": "image/jpeg"}
+        ))
+        clothing = await self.timed("upload_clothing", http.post(
+            "/api/upload/clothing/binary", content=clothing_image, headers={"content-type": "image/jpeg"}
+        ))
+        tryon = await self.timed("tryon", http.post("/api/tryon", json={
+            "person_upload_id": person.json()["upload_id"],
+            "clothing_upload_id": clothing.json()["upload_id"],
+            "bypass_cache": self.args.bypass_cache
+        }))
+        await self.timed("feedback", http.post("/api/feedback", json={
+            "tryon_id": tryon.json()["id"],
+            "rating": random.randint(1, 5),
+            "comment": "load test",
+            "customer_name": f"user-{index}"
+        }))
+        await self.timed("feedback_list", http.get("/api/feedback", params={"limit": 20}))
+        await self.timed("feedback_analytics", http.get("/api/feedback/analytics"))
+        self.completed_sessions += 1
+
+    async def drive(self, base_url: str) -> float:
+        next_session = iter(range(self.args.sessions))
+        limits = httpx.Limits(max_connections=self.args.concurrency, max_keepalive_connections=self.args.concurrency)
+
+        async with httpx.AsyncClient(base_url=base_url, timeout=self.args.timeout, limits=limits) as http:
+            async def virtual_user():
+                for index in next_session:
+                    try:
+                        await self.run_session(http, index)
+                    except Exception:
+                        # Already counted per operation; move on to the next session
+                        pass
+
+            start = time.perf_counter()
+            await asyncio.gather(*[virtual_user() for _ in range(self.args.concurrency)])
+            return time.perf_counter() - start
+
+    def report(self, elapsed: float, peak_rss, gemini_calls: int, webhooks_received: int) -> dict:
+        results = {
+            "sessions": self.args.sessions,
+            "completed_sessions": self.completed_sessions,
+            "concurrency": self.args.concurrency,
+            "gemini_latency_seconds": self.args.gemini_latency,
+            "elapsed_seconds": round(elapsed, 3),
+            "tryons_per_second": round(len(self.latencies["tryon"]) / elapsed, 3) if elapsed else 0.0,
+            "requests_per_second": round(sum(len(values) for values in self.latencies.values()) / elapsed, 3) if elapsed else 0.0,
+            "peak_rss_bytes": peak_rss,
+            "gemini_calls": gemini_calls,
+            "webhooks_received": webhooks_received,
+            "operations": {}
+        }
+        for operation in OPERATIONS:
+            values = self.latencies[operation]
+            results["operations"][operation] = {
+                "count": len(values),
+                "errors": self.errors[operation],
+                "mean_ms": round(sum(values) / len(values) * 1000, 1) if values else 0.0,
+                "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+                "p90_ms": round(percentile(values, 0.90) * 1000, 1),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+                "max_ms": round(max(values) * 1000, 1) if values else 0.0
+            }
+        return results
+
+
+def print_report(results: dict, error_samples: list):
+    print()
+    print(f"Sessions:        {results['completed_sessions']}/{results['sessions']} completed at concurrency {results['concurrency']}")
+    print(f"Elapsed:         {results['elapsed_seconds']:.2f}s (fake Gemini latency {results['gemini_latency_seconds']}s)")
+    print(f"Throughput:      {results['tryons_per_second']:.2f} try-ons/s, {results['requests_per_second']:.2f} requests/s")
+    if results["peak_rss_bytes"]:
+        print(f"Peak RSS:        {results['peak_rss_bytes'] / (1024 * 1024):.1f} MiB")
+    print(f"Gemini calls:    {results['gemini_calls']}, webhooks received: {results['webhooks_received']}")
+    print()
+    print(f"{'operation':<20}{'count':>7}{'errors':>8}{'mean':>10}{'p50':>10}{'p90':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for operation, stats in results["operations"].items():
+        print(
+            f"{operation:<20}{stats['count']:>7}{stats['errors']:>8}"
+            f"{stats['mean_ms']:>10.1f}{stats['p50_ms']:>10.1f}{stats['p90_ms']:>10.1f}"
+            f"{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}"
+        )
+    print("(latencies in ms)")
+    if error_samples:
+        print()
+        print("Sample errors:")
+        for sample in error_samples:
+            print(f"  {sample}")
+
+
+def wait_for_server(base_url: str, process: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited during startup with code {process.returncode}")
+        try:
+            if httpx.get(f"{base_url}/api/", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Server did not become ready in time")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the try-on backend against local fakes")
+    parser.add_argument("--sessions", type=int, default=100, help="virtual user sessions to run in total")
+    parser.add_argument("--concurrency", type=int, default=8, help="sessions running at once")
+    parser.add_argument("--gemini-latency", type=float, default=1.0, help="mean fake Gemini latency in seconds")
+    parser.add_argument("--gemini-jitter", type=float, default=0.1, help="standard deviation of the fake latency")
+    parser.add_argument("--result-edge", type=int, default=1024, help="edge in pixels of the fake generated image")
+    parser.add_argument("--input-width", type=int, default=768, help="width of the uploaded images")
+    parser.add_argument("--input-height", type=int, default=1024, help="height of the uploaded images")
+    parser.add_argument("--image-pool", type=int, default=32, help="distinct person and clothing images to cycle through")
+    parser.add_argument("--bypass-cache", action="store_true", help="send bypass_cache with every try-on")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--keep-db", action="store_true", help="keep the benchmark database afterwards")
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request timeout in seconds")
+    parser.add_argument("--server-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the server process (repeatable)")
+    parser.add_argument("--server-logs", action="store_true", help="show the server's log output")
+    parser.add_argument("--json", dest="json_path", help="also write the results to this JSON file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    load_test = LoadTest(args)
+    load_test.prepare_images()
+
+    gemini_app = create_fake_gemini_app(args.gemini_latency, args.gemini_jitter, make_png(args.result_edge))
+    n8n_app = create_fake_n8n_app()
+    gemini_port, n8n_port, server_port = free_port(), free_port(), free_port()
+    fakes = [ThreadedServer(gemini_app, gemini_port), ThreadedServer(n8n_app, n8n_port)]
+    for fake in fakes:
+        fake.start()
+
+    db_name = f"tryon_load_test_{uuid.uuid4().hex[:8]}"
+    blob_dir = Path(tempfile.mkdtemp(prefix="tryon-load-test-"))
+    env = {
+        **os.environ,
+        "MONGO_URL": args.mongo_url,
+        "DB_NAME": db_name,
+        "GEMINI_API_KEY": "load-test",
+        "GEMINI_BASE_URL": f"http://127.0.0.1:{gemini_port}",
+        "N8N_WEBHOOK_URL": f"http://127.0.0.1:{n8n_port}/webhook",
+        "BLOB_STORE_BACKEND": "local",
+        "BLOB_STORE_DIR": str(blob_dir),
+        "TRACE_FILE": str(blob_dir / "traces.jsonl")
+    }
+    for assignment in args.server_env:
+        name, _, value = assignment.partition("=")
+        env[name] = value
+
+    base_url = f"http://127.0.0.1:{server_port}"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(server_port), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=None if args.server_logs else subprocess.DEVNULL,
+        stderr=None if args.server_logs else subprocess.DEVNULL
+    )
+
+    try:
+        wait_for_server(base_url, server)
+        print(f"Server ready on {base_url}, running {args.sessions} sessions at concurrency {args.concurrency}...")
+        elapsed = asyncio.run(load_test.drive(base_url))
+
+        # Give the webhook outbox a moment to drain before counting deliveries
+        time.sleep(min(5.0, args.gemini_latency + 1.0))
+        peak_rss = peak_rss_bytes(server.pid)
+    finally:
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+        for fake in fakes:
+            fake.stop()
+        if not args.keep_db:
+            with MongoClient(args.mongo_url) as mongo:
+                mongo.drop_database(db_name)
+        shutil.rmtree(blob_dir, ignore_errors=True)
+
+    if peak_rss is None:
+        # Not on Linux: fall back to the high-water mark of reaped children (KiB on Linux, bytes on macOS)
+        max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        peak_rss = max_rss if sys.platform == "darwin" else max_rss * 1024
+
+    results = load_test.report(elapsed, peak_rss, gemini_app.state.calls, n8n_app.state.received)
+    print_report(results, load_test.error_samples)
+
+    if args.json_path:
+        Path(args.json_path).write_text(json.dumps(results, indent=2))
+        print(f"\nResults written to {args.json_path}")
+
+    failed = sum(stats["errors"] for stats in results["operations"].values())
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the per-request CPU work of the upload and try-on handlers.
+
+Every benchmark calls the same functions server.py uses (base64 decode/encode, MIME sniffing,
+image ingestion, cache keys, request validation and response encoding) over a generated corpus
+of phone-camera sized JPEG, PNG and WebP images. Nothing touches MongoDB or Gemini.
+
+Results are compared against a saved baseline, and the run fails when any benchmark got slower
+than the baseline by more than --threshold. Baselines are machine specific, so save one on the
+machine that runs the comparison.
+
+Usage:
+    python backend/benchmarks/microbench.py --save-baseline
+    python backend/benchmarks/microbench.py                      # compare with the saved baseline
+    python backend/benchmarks/microbench.py --filter ingest --threshold 0.10
+"""
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+DEFAULT_BASELINE = BENCHMARKS_DIR / "microbench_baseline.json"
+
+# The benchmarks call pure helpers from backend/server.py, which only needs MONGO_URL and DB_NAME set to import
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "microbench")
+sys.path.insert(0, str(BENCHMARKS_DIR.parent))
+
+import server  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+
+def textured_image(width: int, height: int, seed: int) -> Image.Image:
+    """
+    Smooth random texture with fine grain, which compresses roughly like a photo (flat colors compress far better)
+    """
+    rng = random.Random(seed)
+    coarse = Image.frombytes("RGB", (width // 16, height // 16), rng.randbytes((width // 16) * (height // 16) * 3))
+    image = coarse.resize((width, height), Image.BICUBIC)
+    grain = Image.effect_noise((width, height), 24).convert("RGB")
+    return Image.blend(image, grain, 0.12)
+
+
+def build_corpus() -> dict:
+    corpus = {}
+
+    # 12 MP phone photo, rotated via EXIF like most portrait shots
+    photo = textured_image(4032, 3024, seed=1)
+    exif = photo.getexif()
+    exif[0x0112] = 6
+    buffer = io.BytesIO()
+    photo.save(buffer, "JPEG", quality=92, exif=exif)
+    corpus["jpeg_12mp_exif"] = buffer.getvalue()
+
+    # What the frontend sends after its own resize
+    buffer = io.BytesIO()
+    textured_image(768, 1024, seed=2).save(buffer, "JPEG", quality=90)
+    corpus["jpeg_1024_frontend"] = buffer.getvalue()
+
+    # Garment cut-out with transparency, as shared from shopping apps
+    garment = textured_image(1080, 1920, seed=3).convert("RGBA")
+    mask = Image.new("L", garment.size, 0)
+    mask.paste(255, (120, 200, 960, 1720))
+    garment.putalpha(mask)
+    buffer = io.BytesIO()
+    garment.save(buffer, "PNG")
+    corpus["png_1080x1920_alpha"] = buffer.getvalue()
+
+    buffer = io.BytesIO()
+    textured_image(2048, 1536, seed=4).save(buffer, "WEBP", quality=85)
+    corpus["webp_2048"] = buffer.getvalue()
+
+    # A typical generated result, as returned by Gemini
+    buffer = io.BytesIO()
+    textured_image(896, 1152, seed=5).save(buffer, "PNG")
+    corpus["result_png_896x1152"] = buffer.getvalue()
+
+    return corpus
+
+
+def build_benchmarks(corpus: dict) -> dict:
+    benchmarks = {}
+    inputs = {name: data for name, data in corpus.items() if not name.startswith("result_")}
+    result_image = corpus["result_png_896x1152"]
+    result_b64 = base64.b64encode(result_image).decode("utf-8")
+
+    for name, data in inputs.items():
+        encoded = base64.b64encode(data).decode("utf-8")
+        body = json.dumps({"person_image": encoded, "clothing_image": encoded})
+        metadata = server.describe_image(data)
+
+        benchmarks[f"base64_decode[{name}]"] = lambda encoded=encoded: server.decode_base64(encoded)
+        benchmarks[f"mime_sniff[{name}]"] = lambda data=data: server.detect_mime_type(data)
+        benchmarks[f"sha256[{name}]"] = lambda data=data: hashlib.sha256(data).hexdigest()
+        benchmarks[f"describe_image[{name}]"] = lambda data=data: server.describe_image(data)
+        benchmarks[f"ingest_image[{name}]"] = lambda data=data: server.ingest_image(
+            data, server.IMAGE_MAX_EDGE, server.IMAGE_NORMALIZE_FORMAT, server.IMAGE_NORMALIZE_QUALITY
+        )
+        # What FastAPI does with a direct-image /api/tryon body: parse the JSON, then validate the model
+        benchmarks[f"tryon_request_validate[{name}]"] = lambda body=body: server.TryOnRequest(**json.loads(body))
+        benchmarks[f"cache_key[{name}]"] = lambda sha=metadata["sha256"]: server.compute_tryon_cache_key(
+            [sha, sha], server.TRYON_PROMPT, server.GEMINI_IMAGE_MODEL, "3:4"
+        )
+
+    benchmarks["base64_encode[result]"] = lambda: server.encode_base64(result_image)
+
+    def encode_json_response():
+        response = server.TryOnResponse(
+            id="00000000-0000-0000-0000-000000000000",
+            result_image=server.encode_base64(result_image),
+            timestamp=server.datetime.utcnow(),
+            status="completed"
+        )
+        return JSONResponse(content=jsonable_encoder(response)).body
+
+    benchmarks["tryon_response_json[result]"] = encode_json_response
+    benchmarks["tryon_response_decode[result]"] = lambda: base64.b64decode(json.loads(
+        json.dumps({"result_image": result_b64})
+    )["result_image"])
+    return benchmarks
+
+
+def measure(func, min_round_seconds: float, rounds: int) -> dict:
+    """
+    Time func in several rounds; each round repeats it enough times to last min_round_seconds.
+    Reports the median round, which is stable against the occasional noisy round.
+    """
+    func()  # warm up caches and lazy imports
+
+    iterations = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_round_seconds:
+            break
+        iterations = max(iterations * 2, int(iterations * min_round_seconds / max(elapsed, 1e-9) * 1.1))
+
+    per_call = [elapsed / iterations]
+    for _ in range(rounds - 1):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        per_call.append((time.perf_counter() - start) / iterations)
+
+    return {
+        "median_us": statistics.median(per_call) * 1e6,
+        "min_us": min(per_call) * 1e6,
+        "iterations": iterations,
+        "rounds": rounds
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get("results", {}).get(name)
+        if reference is None:
+            continue
+        change = result["median_us"] / reference["median_us"] - 1
+        result["baseline_us"] = reference["median_us"]
+        result["change"] = change
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def print_results(results: dict, threshold: float):
+    print(f"{'benchmark':<48}{'median':>12}{'min':>12}{'baseline':>12}{'change':>9}")
+    for name, result in results.items():
+        baseline = f"{result['baseline_us']:>12.1f}" if "baseline_us" in result else f"{'-':>12}"
+        if "change" in result:
+            marker = " !" if result["change"] > threshold else ""
+            change = f"{result['change'] * 100:>+8.1f}%{marker}"
+        else:
+            change = f"{'-':>9}"
+        print(f"{name:<48}{result['median_us']:>12.1f}{result['min_us']:>12.1f}{baseline}{change}")
+    print("(times in microseconds per call)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the image ingest and serialization hot paths")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE, help="baseline file to compare with or save to")
+    parser.add_argument("--save-baseline", action="store_true", help="save this run as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed slowdown before failing (0.15 = 15%%)")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this text")
+    parser.add_argument("--rounds", type=int, default=7, help="timed rounds per benchmark")
+    parser.add_argument("--min-round-seconds", type=float, default=0.2, help="minimum duration of one round")
+    parser.add_argument("--json", dest="json_path", type=Path, help="also write this run's results to a file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    print("Building image corpus...")
+    corpus = build_corpus()
+    for name, data in corpus.items():
+        print(f"  {name}: {len(data) / 1024:.0f} KiB")
+
+    benchmarks = {name: func for name, func in build_benchmarks(corpus).items() if args.filter in name}
+    if not benchmarks:
+        sys.exit(f"No benchmark matches filter {args.filter!r}")
+
+    results = {}
+    for name, func in benchmarks.items():
+        results[name] = measure(func, args.min_round_seconds, args.rounds)
+        print(f"  {name}: {results[name]['median_us']:.1f} us")
+    print()
+
+    run = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "image_max_edge": server.IMAGE_MAX_EDGE,
+        "results": results
+    }
+
+    regressions = []
+    if args.save_baseline:
+        if args.filter and args.baseline.exists():
+            # A filtered run only replaces the benchmarks it ran
+            saved = json.loads(args.baseline.read_text())
+            saved["results"].update(results)
+            run = {**run, "results": saved["results"]}
+        args.baseline.write_text(json.dumps(run, indent=2))
+        print_results(results, args.threshold)
+        print(f"\nBaseline saved to {args.baseline}")
+    elif args.baseline.exists():
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.threshold)
+        print_results(results, args.threshold)
+    else:
+        print_results(results, args.threshold)
+        print(f"\nNo baseline at {args.baseline}, run with --save-baseline to create one")
+
+    if args.json_path:
+        args.json_path.write_text(json.dumps(run, indent=2))
+
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) slower than baseline by more than {args.threshold:.0%}:")
+        for name in regressions:
+            print(f"  {name}: {results[name]['change']:+.1%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
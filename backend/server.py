@@ -1,21 +1,47 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, UploadFile, File, Form
+from fastapi.responses import StreamingResponse, JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from gridfs.errors import NoFile
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional
 import uuid
-from datetime import datetime
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+import random
 import asyncio
 import base64
+import binascii
+import json
 from google import genai
 from google.genai import types
+from google.genai import errors as genai_errors
 import httpx
-from PIL import Image
+from PIL import Image, ImageOps
 import io
+import gzip
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from bson import BSON, json_util
+import hashlib
+import hmac
+import secrets
+import time
+import math
+import sys
+import threading
+import traceback
+import itertools
+import contextvars
+from collections import deque, Counter
+from contextlib import contextmanager, asynccontextmanager
+from cachetools import TTLCache
+from python_multipart.multipart import MultipartParser, parse_options_header
 
 
 ROOT_DIR = Path(__file__).parent
@@ -47,12 +73,16 @@ class TryOnRequest(BaseModel):
     clothing_image: Optional[str] = None  # base64 encoded image (for backward compatibility)
     person_upload_id: Optional[str] = None  # upload ID from /api/upload/person
     clothing_upload_id: Optional[str] = None  # upload ID from /api/upload/clothing
+    clothing_images: Optional[List[str]] = None  # base64 encoded garments of an outfit, applied in order
+    clothing_upload_ids: Optional[List[str]] = None  # upload IDs of an outfit's garments, applied in order
+    bypass_cache: bool = False  # force a fresh generation even if an identical result is cached
 
 class TryOnResponse(BaseModel):
     id: str
     result_image: str  # base64 encoded image
     timestamp: datetime
     status: str
+    cached: bool = False  # True when the result was served from the result cache
 
 class FeedbackRequest(BaseModel):
     tryon_id: str
@@ -67,396 +97,2941 @@ class ImageUploadResponse(BaseModel):
     upload_id: str
     timestamp: datetime
     status: str
+    mime_type: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    aspect_ratio: Optional[str] = None
 
 class TryOnWithIdsRequest(BaseModel):
     person_upload_id: str
     clothing_upload_id: str
 
+class TryOnBatchRequest(BaseModel):
+    person_upload_id: str  # upload ID from /api/upload/person
+    clothing_upload_ids: List[str]  # upload IDs from /api/upload/clothing, one try-on each
+    bypass_cache: bool = False
+
+class TryOnJobResponse(BaseModel):
+    job_id: str
+    status: str  # queued, running, completed or failed
+    timestamp: datetime
+    result_image: Optional[str] = None  # base64 encoded image, set once completed
+    error: Optional[str] = None  # set when failed
+    cached: bool = False
+
+
+# Metrics Configuration
+# Exposed in the Prometheus text format at /metrics; buckets span quick JSON routes up to slow generations
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+
+def format_metric_labels(label_names, label_values, extra=()) -> str:
+    pairs = [*zip(label_names, label_values), *extra]
+    if not pairs:
+        return ""
+    escaped = [
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    ]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class MetricCounter:
+    """
+    Monotonically increasing counter, one series per combination of label values
+    """
+    
+    def __init__(self, name: str, help_text: str, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+    
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        self.values[key] = self.values.get(key, 0.0) + amount
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_metric_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class MetricHistogram:
+    """
+    Cumulative histogram, one series per combination of label values
+    """
+    
+    def __init__(self, name: str, help_text: str, label_names=(), buckets=METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.series = {}
+    
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["buckets"][index] += 1
+        series["sum"] += value
+        series["count"] += 1
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, series["buckets"]):
+                lines.append(f"{self.name}_bucket{format_metric_labels(self.label_names, key, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_bucket{format_metric_labels(self.label_names, key, [('le', '+Inf')])} {series['count']}")
+            lines.append(f"{self.name}_sum{format_metric_labels(self.label_names, key)} {series['sum']}")
+            lines.append(f"{self.name}_count{format_metric_labels(self.label_names, key)} {series['count']}")
+        return lines
+
+
+def render_gauge(name: str, help_text: str, value: float, label_names=(), label_values=()) -> List[str]:
+    return [
+        f"# HELP {name} {help_text}",
+        f"# TYPE {name} gauge",
+        f"{name}{format_metric_labels(label_names, label_values)} {value}"
+    ]
+
+
+http_requests_total = MetricCounter(
+    "http_requests_total", "HTTP requests by method, route template and status code", ("method", "route", "status")
+)
+http_request_duration_seconds = MetricHistogram(
+    "http_request_duration_seconds", "HTTP request latency by method and route template", ("method", "route")
+)
+tryon_stage_duration_seconds = MetricHistogram(
+    "tryon_stage_duration_seconds", "Time spent in each stage of the try-on pipeline", ("stage",)
+)
+
+
+# Tracing Configuration
+# Every request collects timed spans, returned in a Server-Timing header and logged as one JSON trace record.
+# Requests slower than TRACE_SLOW_REQUEST_SECONDS (0 disables) also get a sampling profile in TRACE_FILE.
+TRACE_SLOW_REQUEST_SECONDS = float(os.environ.get("TRACE_SLOW_REQUEST_SECONDS", "0"))
+TRACE_PROFILE_INTERVAL_SECONDS = float(os.environ.get("TRACE_PROFILE_INTERVAL_SECONDS", "0.02"))
+TRACE_PROFILE_MAX_STACKS = int(os.environ.get("TRACE_PROFILE_MAX_STACKS", "50"))
+TRACE_FILE = Path(os.environ.get("TRACE_FILE", str(ROOT_DIR / "traces" / "slow_requests.jsonl")))
+
+# The trace of the request being handled; tasks started by the request inherit it
+request_trace = contextvars.ContextVar("request_trace", default=None)
+
+
+def record_span(name: str, start: float, duration: float):
+    trace = request_trace.get()
+    if trace is not None:
+        trace["spans"].append((name, start - trace["start"], duration))
+
+
+@contextmanager
+def trace_span(name: str):
+    """
+    Time a block as a span of the current request's trace (works around awaits too)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, start, time.perf_counter() - start)
+
+
+@contextmanager
+def tryon_stage(stage: str):
+    """
+    Time a stage of the try-on pipeline into the stage histogram and the request's trace
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        tryon_stage_duration_seconds.observe(duration, stage=stage)
+        record_span(stage, start, duration)
+
+
+def collapse_stack(thread_name: str, frame) -> str:
+    """
+    One sampled stack in collapsed form (root first), as consumed by flame graph tools
+    """
+    entries = [
+        f"{os.path.basename(entry.filename)}:{entry.name}:{entry.lineno}"
+        for entry in traceback.extract_stack(frame, limit=64)
+    ]
+    return ";".join([f"thread:{thread_name}", *entries])
+
+
+class SlowRequestProfiler:
+    """
+    Samples the stacks of every thread while a request has been running longer than the threshold.
+    Runs in a daemon thread so it keeps sampling while the event loop itself is blocked.
+    Samples are process wide: concurrent slow requests share them.
+    """
+    
+    def __init__(self, threshold: float, interval: float):
+        self.threshold = threshold
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {}
+        self.keys = itertools.count()
+        self.stopped = threading.Event()
+        self.thread = None
+    
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.stopped.set()
+    
+    def begin(self) -> int:
+        key = next(self.keys)
+        with self.lock:
+            self.active[key] = {"start": time.monotonic(), "samples": Counter()}
+        return key
+    
+    def end(self, key: int) -> Counter:
+        with self.lock:
+            return self.active.pop(key)["samples"]
+    
+    def _run(self):
+        own_thread_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            now = time.monotonic()
+            with self.lock:
+                slow = [entry for entry in self.active.values() if now - entry["start"] >= self.threshold]
+            if not slow:
+                continue
+            
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = [
+                collapse_stack(thread_names.get(thread_id, str(thread_id)), frame)
+                for thread_id, frame in sys._current_frames().items()
+                if thread_id != own_thread_id
+            ]
+            with self.lock:
+                for entry in slow:
+                    entry["samples"].update(stacks)
+
+
+# Created at startup when TRACE_SLOW_REQUEST_SECONDS is set
+slow_request_profiler = None
+trace_file_lock = threading.Lock()
+
+
+def append_trace_record(record: dict):
+    with trace_file_lock:
+        TRACE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(TRACE_FILE, "a") as trace_file:
+            trace_file.write(json.dumps(record) + "\n")
+
+
+def format_server_timing(spans: List[tuple], total: float) -> str:
+    """
+    Server-Timing header value; repeated spans (e.g. one per image) are summed into one entry
+    """
+    durations = {}
+    for name, _, duration in spans:
+        durations[name] = durations.get(name, 0.0) + duration
+    entries = [f"{name};dur={duration * 1000:.1f}" for name, duration in durations.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+# Gemini Configuration
+GEMINI_IMAGE_MODEL = "gemini-3-pro-image-preview"
+
+# Original text prompt (kept for reference)
+# text_prompt = """Your task is to perform a virtual try-on. The first image contains a person. The second image contains one or more clothing items. Identify the garments (e.g., shirt, pants, jacket) in the second image, ignoring any person or mannequin wearing them. Then, generate a new, photorealistic image where the person from the first image is wearing those garments. The person's original pose, face, and the background should be maintained."""
+
+# Enhanced prompt with strongest identity preservation + Headwear support
+TRYON_PROMPT = """**Primary Directive: High-Fidelity Virtual Try-On**
+
+You are an expert digital tailor. Your task is to execute a precise clothing/accessory swap.
+
+**!!! CORE SAFETY DIRECTIVE: PROTECT FACIAL IDENTITY !!!**
+**The person's facial features (eyes, nose, mouth, jawline, skin tone) in Image 1 are a STRICT NO-EDIT ZONE. They must be preserved perfectly to maintain identity. Any distortion to the face is a failure.**
+
+**Input Definitions:**
+- **Image 1 (The Canvas):** Contains the person.
+- **Image 2 (The Source):** Contains the garment(s) or accessory.
+
+**--- CRITICAL RULES ---**
+
+1.  **PRESERVE THE CANVAS:** Keep the original pose, background, and **ASPECT RATIO** exactly as they are in Image 1. Do not crop, stretch, or resize the person.
+2.  **SMART MAPPING (Headwear Exception):** 
+    - generally, do NOT edit the head or hair.
+    - **HOWEVER**, if the source item is **HEADWEAR** (hat, cap, beanie, sunglasses, etc.), you **MUST** apply it to the person's head/face appropriately, modifying hair/head shape only as needed to fit the item realistically.
+3.  **EXTRACT FROM THE SOURCE:** Accurately transfer the color, pattern, and texture from Image 2.
+4.  **DISCARD ORIGINAL CLOTHING:** Ignore the old clothes in the target area.
+
+**--- STEP-BY-STEP EXECUTION ---**
+
+1.  **Analyze Source:** Is it a shirt? Pants? A Hat? A Dress?
+2.  **Map Target:** 
+    - If Shirt/Pants/Dress -> Map to body, exclude head/hands.
+    - If Hat/Glasses -> Map to head/face, preserving identity features underneath.
+3.  **Render:** Generate the photorealistic result within the exact bounds of Image 1.
+
+**!! FINAL MANDATE !!**
+Identity protected. Clothing/Accessory perfectly transferred. Photorealistic. No stretching or distortion."""
+
+# Outfits apply several garments in one generation; Image 1 stays the person and the garments follow in request order
+TRYON_MAX_GARMENTS = int(os.environ.get("TRYON_MAX_GARMENTS", "4"))
+
+TRYON_OUTFIT_PROMPT = """**Primary Directive: High-Fidelity Virtual Outfit Try-On**
+
+You are an expert digital tailor. Your task is to dress the person in a complete outfit made of {garment_count} items, in a single pass.
+
+**!!! CORE SAFETY DIRECTIVE: PROTECT FACIAL IDENTITY !!!**
+**The person's facial features (eyes, nose, mouth, jawline, skin tone) in Image 1 are a STRICT NO-EDIT ZONE. They must be preserved perfectly to maintain identity. Any distortion to the face is a failure.**
+
+**Input Definitions:**
+- **Image 1 (The Canvas):** Contains the person.
+{garment_sources}
+
+**--- CRITICAL RULES ---**
+
+1.  **PRESERVE THE CANVAS:** Keep the original pose, background, and **ASPECT RATIO** exactly as they are in Image 1. Do not crop, stretch, or resize the person.
+2.  **USE EVERY SOURCE:** Each source image contributes its item to the outfit. Every item must be visible in the result.
+3.  **LAYERING ORDER:** Sources are listed from the innermost layer to the outermost. If two items cover the same body area (e.g. a shirt and a jacket), the later source is worn over the earlier one. If two items cannot be worn together (e.g. two pairs of pants), the later source wins.
+4.  **SMART MAPPING (Headwear Exception):** 
+    - generally, do NOT edit the head or hair.
+    - **HOWEVER**, if a source item is **HEADWEAR** (hat, cap, beanie, sunglasses, etc.), you **MUST** apply it to the person's head/face appropriately, modifying hair/head shape only as needed to fit the item realistically.
+5.  **EXTRACT FROM EACH SOURCE:** Accurately transfer the color, pattern, and texture of each item from its own source image. Never mix details between sources.
+6.  **DISCARD ORIGINAL CLOTHING:** Ignore the old clothes in every area covered by a source item. Keep the original clothing where no source item applies.
+
+**--- STEP-BY-STEP EXECUTION ---**
+
+1.  **Analyze Sources:** For each source, is it a shirt? Pants? A Hat? A Dress? A Jacket?
+2.  **Map Targets:** 
+    - If Shirt/Pants/Dress/Jacket -> Map to body, exclude head/hands, layered in source order.
+    - If Hat/Glasses -> Map to head/face, preserving identity features underneath.
+3.  **Render:** Generate one photorealistic result within the exact bounds of Image 1, wearing the whole outfit.
+
+**!! FINAL MANDATE !!**
+Identity protected. Every item of the outfit perfectly transferred and correctly layered. Photorealistic. No stretching or distortion."""
+
+
+def build_tryon_prompt(garment_count: int) -> str:
+    """
+    Prompt for dressing the person in garment_count items; a single garment keeps the original prompt
+    """
+    if garment_count == 1:
+        return TRYON_PROMPT
+    garment_sources = "\n".join(
+        f"- **Image {position + 2} (Source {position + 1}):** Contains outfit item {position + 1} of {garment_count}."
+        for position in range(garment_count)
+    )
+    return TRYON_OUTFIT_PROMPT.format(garment_count=garment_count, garment_sources=garment_sources)
+
+
+# Gemini Client Pool Configuration
+# GEMINI_API_KEYS is a comma-separated list of keys (e.g. one per project); GEMINI_API_KEY is used when unset
+GEMINI_PER_KEY_CONCURRENCY = int(os.environ.get("GEMINI_PER_KEY_CONCURRENCY", "8"))
+GEMINI_KEY_COOLDOWN_SECONDS = float(os.environ.get("GEMINI_KEY_COOLDOWN_SECONDS", "60"))
+# Points the clients at another Gemini-compatible endpoint, e.g. the fake server in backend/benchmarks
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL")
+
+
+class GeminiKeySlot:
+    """
+    One long-lived Gemini client for a single API key, with its own concurrency limit and quota counters
+    """
+    
+    def __init__(self, index: int, api_key: str):
+        self.index = index
+        self.key_suffix = api_key[-4:]
+        self.client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(base_url=GEMINI_BASE_URL) if GEMINI_BASE_URL else None
+        )
+        self.semaphore = asyncio.Semaphore(GEMINI_PER_KEY_CONCURRENCY)
+        self.load = 0  # requests waiting for or holding this key
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.cooldown_until = 0.0
+        self.recent_requests = deque()
+    
+    def is_cooling_down(self) -> bool:
+        return time.monotonic() < self.cooldown_until
+    
+    def requests_last_minute(self) -> int:
+        cutoff = time.monotonic() - 60
+        while self.recent_requests and self.recent_requests[0] < cutoff:
+            self.recent_requests.popleft()
+        return len(self.recent_requests)
+    
+    def stats(self) -> dict:
+        return {
+            "key": f"...{self.key_suffix}",
+            "in_flight": self.in_flight,
+            "waiting": self.load - self.in_flight,
+            "requests": self.requests,
+            "requests_last_minute": self.requests_last_minute(),
+            "failures": self.failures,
+            "rate_limited": self.rate_limited,
+            "cooling_down": self.is_cooling_down()
+        }
+
+
+class GeminiClientPool:
+    """
+    Application-scoped Gemini clients, one per API key.
+    Calls go to the least loaded key that is not cooling down after a rate limit,
+    and a rate-limited call is retried once on every other available key.
+    """
+    
+    def __init__(self, api_keys: List[str]):
+        self.slots = [GeminiKeySlot(index, api_key) for index, api_key in enumerate(api_keys)]
+    
+    def _pick_slot(self, exclude) -> Optional[GeminiKeySlot]:
+        candidates = [slot for slot in self.slots if slot.index not in exclude]
+        if not candidates:
+            return None
+        available = [slot for slot in candidates if not slot.is_cooling_down()]
+        if available:
+            return min(available, key=lambda slot: (slot.load, slot.requests_last_minute()))
+        if exclude:
+            # Every remaining key is rate limited, let the caller see the original error
+            return None
+        return min(candidates, key=lambda slot: slot.cooldown_until)
+    
+    async def warm_up(self, model: str):
+        """
+        Open connections (DNS, TCP and TLS) for every key before the first try-on arrives
+        """
+        async def warm_slot(slot: GeminiKeySlot):
+            try:
+                await slot.client.aio.models.get(model=model)
+                logger.info(f"Gemini client for key ...{slot.key_suffix} warmed up")
+            except Exception as e:
+                logger.warning(f"Failed to warm up Gemini client for key ...{slot.key_suffix}: {e}")
+        
+        await asyncio.gather(*[warm_slot(slot) for slot in self.slots])
+    
+    async def generate_content(self, **kwargs):
+        tried = set()
+        while True:
+            slot = self._pick_slot(tried)
+            if slot is None:
+                raise HTTPException(status_code=500, detail="Gemini API key not configured")
+            tried.add(slot.index)
+            
+            slot.load += 1
+            try:
+                async with slot.semaphore:
+                    slot.in_flight += 1
+                    slot.requests += 1
+                    slot.recent_requests.append(time.monotonic())
+                    try:
+                        # The async client waits on the connection without holding a thread per generation
+                        return await slot.client.aio.models.generate_content(**kwargs)
+                    finally:
+                        slot.in_flight -= 1
+            except genai_errors.APIError as e:
+                slot.failures += 1
+                if e.code != 429:
+                    raise
+                slot.rate_limited += 1
+                slot.cooldown_until = time.monotonic() + GEMINI_KEY_COOLDOWN_SECONDS
+                logger.warning(f"Gemini key ...{slot.key_suffix} rate limited, cooling down for {GEMINI_KEY_COOLDOWN_SECONDS}s")
+                if self._pick_slot(tried) is None:
+                    raise
+            except Exception:
+                slot.failures += 1
+                raise
+            finally:
+                slot.load -= 1
+    
+    def stats(self) -> List[dict]:
+        return [slot.stats() for slot in self.slots]
+    
+    async def close(self):
+        for slot in self.slots:
+            await slot.client.aio.aclose()
+            slot.client.close()
+
+
+def load_gemini_api_keys() -> List[str]:
+    api_keys = [key.strip() for key in os.environ.get("GEMINI_API_KEYS", "").split(",") if key.strip()]
+    if not api_keys and os.environ.get("GEMINI_API_KEY"):
+        api_keys = [os.environ["GEMINI_API_KEY"]]
+    return api_keys
+
+
+# Generation Admission Control
+# At most GEMINI_MAX_CONCURRENT_GENERATIONS generations run at once across all keys. Further requests wait in a
+# queue of at most GEMINI_MAX_QUEUED_GENERATIONS for up to GEMINI_QUEUE_TIMEOUT_SECONDS, and are turned away with
+# Retry-After when the queue is full (429) or the wait runs out (503) instead of piling up blocked threads.
+GEMINI_MAX_CONCURRENT_GENERATIONS = int(os.environ.get("GEMINI_MAX_CONCURRENT_GENERATIONS", "16"))
+GEMINI_MAX_QUEUED_GENERATIONS = int(os.environ.get("GEMINI_MAX_QUEUED_GENERATIONS", "32"))
+GEMINI_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_QUEUE_TIMEOUT_SECONDS", "20"))
+GEMINI_RETRY_AFTER_MAX_SECONDS = 120
+
+gemini_admission_rejections_total = MetricCounter(
+    "gemini_admission_rejections_total", "Generations turned away by admission control", ("reason",)
+)
+
+
+class GenerationAdmission:
+    """
+    Global cap on concurrent Gemini generations with a bounded wait queue and a queue-time deadline.
+    Background jobs are admitted with bounded=False: they wait as long as it takes, since the job queue
+    already holds them, but still count towards the queue depth.
+    """
+    
+    def __init__(self, max_concurrent: int, max_queued: int, queue_timeout: float):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.running = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = Counter()
+        self.average_seconds = None  # moving average of generation time, used for Retry-After
+    
+    def retry_after(self) -> int:
+        """
+        Seconds until the generations ahead of a new request have likely drained
+        """
+        average = self.average_seconds or 10.0
+        rounds = max(1.0, (self.running + self.queued) / self.max_concurrent)
+        return max(1, min(GEMINI_RETRY_AFTER_MAX_SECONDS, math.ceil(average * rounds)))
+    
+    def reject(self, reason: str, status_code: int, detail: str):
+        self.rejected[reason] += 1
+        gemini_admission_rejections_total.inc(reason=reason)
+        logger.warning(f"Generation rejected ({reason}): {self.running} running, {self.queued} queued")
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(self.retry_after())})
+    
+    @asynccontextmanager
+    async def slot(self, bounded: bool = True):
+        # Check and count before the first await, so every request of a same-tick burst sees the ones before it
+        if bounded and self.running + self.queued >= self.max_concurrent + self.max_queued:
+            self.reject("queue_full", 429, "Too many try-ons in progress, please retry later")
+        
+        self.queued += 1
+        try:
+            with tryon_stage("admission_wait"):
+                if bounded:
+                    await asyncio.wait_for(self.semaphore.acquire(), timeout=self.queue_timeout)
+                else:
+                    await self.semaphore.acquire()
+        except asyncio.TimeoutError:
+            self.reject("queue_timeout", 503, "Try-on service is busy, please retry later")
+        finally:
+            self.queued -= 1
+        
+        self.running += 1
+        self.admitted += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+            duration = time.perf_counter() - start
+            if self.average_seconds is None:
+                self.average_seconds = duration
+            else:
+                self.average_seconds = 0.8 * self.average_seconds + 0.2 * duration
+    
+    def stats(self) -> dict:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queued": self.max_queued,
+            "queue_timeout_seconds": self.queue_timeout,
+            "running": self.running,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "average_generation_seconds": self.average_seconds,
+            "retry_after_seconds": self.retry_after()
+        }
+
+
+generation_admission = GenerationAdmission(
+    GEMINI_MAX_CONCURRENT_GENERATIONS, GEMINI_MAX_QUEUED_GENERATIONS, GEMINI_QUEUE_TIMEOUT_SECONDS
+)
+
+# Created at startup and shared by every request
+gemini_pool = None
+
+
+def detect_mime_type(image_bytes: bytes) -> str:
+    """
+    Detect actual mime type from image bytes by checking magic bytes
+    """
+    if image_bytes.startswith(b'\xff\xd8\xff'):
+        return "image/jpeg"
+    elif image_bytes.startswith(b'\x89PNG'):
+        return "image/png"
+    elif image_bytes.startswith(b'RIFF') and image_bytes[8:12] == b'WEBP':
+        return "image/webp"
+    elif image_bytes.startswith(b'GIF87a') or image_bytes.startswith(b'GIF89a'):
+        return "image/gif"
+    else:
+        # Default to jpeg if unknown
+        return "image/jpeg"
+
+
+# Image Normalization Configuration
+# Images are downscaled to IMAGE_MAX_EDGE pixels on their longest edge (0 disables normalization).
+# The defaults match the frontend's useImageProcessor resize, so its images pass through untouched.
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", "1024"))
+IMAGE_NORMALIZE_FORMAT = os.environ.get("IMAGE_NORMALIZE_FORMAT", "JPEG").upper()
+IMAGE_NORMALIZE_QUALITY = int(os.environ.get("IMAGE_NORMALIZE_QUALITY", "90"))
+IMAGE_PROCESS_WORKERS = int(os.environ.get("IMAGE_PROCESS_WORKERS", "2"))
+
+# Created at startup so Pillow work never runs on the event loop
+image_process_pool = None
+image_process_stats = {"pending": 0}  # submitted to the pool and not finished yet
+
+
+async def run_in_image_process_pool(func, *args):
+    image_process_stats["pending"] += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(image_process_pool, func, *args)
+    finally:
+        image_process_stats["pending"] -= 1
+
+
+# CPU Executor Configuration
+# Threads for CPU-bound work too small to ship to the image process pool (base64 of request and result images).
+# Kept apart from the default executor, so it never queues behind blocking blob or file I/O.
+CPU_EXECUTOR_WORKERS = int(os.environ.get("CPU_EXECUTOR_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Characters decoded per slice (a multiple of 4); the GIL is released between slices
+BASE64_SLICE_CHARS = 256 * 1024
+
+# Created at startup
+cpu_executor = None
+cpu_executor_stats = {"pending": 0}  # submitted to the executor and not finished yet
+
+
+async def run_in_cpu_executor(func, *args):
+    cpu_executor_stats["pending"] += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(cpu_executor, func, *args)
+    finally:
+        cpu_executor_stats["pending"] -= 1
+
+
+def decode_base64(encoded: str) -> bytes:
+    """
+    base64.b64decode in slices. A single b64decode call holds the GIL for the whole image (around 20 ms
+    for a 12 MP photo), which would stall the event loop even from another thread.
+    Input with whitespace or other stray characters falls back to one lenient decode, like base64.b64decode.
+    """
+    if len(encoded) <= BASE64_SLICE_CHARS:
+        return base64.b64decode(encoded)
+    try:
+        return b"".join(
+            base64.b64decode(encoded[start:start + BASE64_SLICE_CHARS], validate=True)
+            for start in range(0, len(encoded), BASE64_SLICE_CHARS)
+        )
+    except binascii.Error:
+        return base64.b64decode(encoded)
+
+
+def encode_base64(data: bytes) -> str:
+    """
+    base64.b64encode(...).decode() in slices, for the same reason as decode_base64
+    """
+    slice_bytes = BASE64_SLICE_CHARS // 4 * 3
+    if len(data) <= slice_bytes:
+        return base64.b64encode(data).decode('utf-8')
+    view = memoryview(data)
+    return "".join(
+        base64.b64encode(view[start:start + slice_bytes]).decode('utf-8')
+        for start in range(0, len(data), slice_bytes)
+    )
+
+
+async def decode_base64_image(encoded: str) -> bytes:
+    return await run_in_cpu_executor(decode_base64, encoded)
+
+
+async def decode_request_image(encoded: str, field_name: str) -> bytes:
+    """
+    Decode a base64 image sent by the client, answering malformed input with a 400
+    """
+    try:
+        return await decode_base64_image(encoded)
+    except (binascii.Error, ValueError):
+        # ValueError covers non-ASCII input, which never reaches the base64 decoder
+        raise HTTPException(status_code=400, detail=f"{field_name} is not valid base64")
+
+
+async def encode_base64_image(image_bytes: bytes) -> str:
+    return await run_in_cpu_executor(encode_base64, image_bytes)
+
+
+def normalize_image(image_bytes: bytes, max_edge: int, output_format: str, quality: int) -> bytes:
+    """
+    Apply EXIF orientation, downscale to max_edge and re-encode to output_format.
+    Runs in the image process pool, so it must stay a module-level function.
+    Images that already satisfy every constraint are returned unchanged.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        orientation = img.getexif().get(0x0112, 1)
+        needs_resize = max(img.size) > max_edge
+        if not needs_resize and orientation == 1 and img.format == output_format:
+            return image_bytes
+        
+        normalized = ImageOps.exif_transpose(img)
+        if needs_resize:
+            normalized.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        
+        if output_format == "JPEG" and normalized.mode != "RGB":
+            if normalized.mode in ("RGBA", "LA") or "transparency" in normalized.info:
+                # JPEG has no alpha channel, flatten transparent garments onto white
+                rgba = normalized.convert("RGBA")
+                background = Image.new("RGB", rgba.size, (255, 255, 255))
+                background.paste(rgba, mask=rgba.split()[3])
+                normalized = background
+            else:
+                normalized = normalized.convert("RGB")
+        
+        output = io.BytesIO()
+        if output_format == "JPEG":
+            normalized.save(output, format="JPEG", quality=quality, optimize=True)
+        else:
+            normalized.save(output, format=output_format, quality=quality)
+        return output.getvalue()
+
+
+# Gemini only renders these output aspect ratios; the person image picks the closest one
+GEMINI_ASPECT_RATIOS = {
+    "1:1": 1.0,
+    "3:4": 0.75,
+    "4:3": 1.33,
+    "9:16": 0.5625,
+    "16:9": 1.77
+}
+
+
+def closest_aspect_ratio(width: int, height: int) -> str:
+    ratio = width / height
+    return min(GEMINI_ASPECT_RATIOS.items(), key=lambda x: abs(x[1] - ratio))[0]
+
+
+def describe_image(image_bytes: bytes) -> dict:
+    """
+    Read everything the try-on path needs to know about an image, raising if Pillow cannot open it.
+    Runs in the image process pool, so it must stay a module-level function.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        width, height = img.size
+        mime_type = Image.MIME.get(img.format) or detect_mime_type(image_bytes)
+    return {
+        "mime_type": mime_type,
+        "width": width,
+        "height": height,
+        "aspect_ratio": closest_aspect_ratio(width, height),
+        "sha256": hashlib.sha256(image_bytes).hexdigest()
+    }
+
+
+def ingest_image(image_bytes: bytes, max_edge: int, output_format: str, quality: int) -> tuple:
+    """
+    Normalize (when max_edge > 0) and describe an image in one pass. Returns (image_bytes, metadata).
+    Runs in the image process pool, so it must stay a module-level function.
+    """
+    if max_edge > 0:
+        try:
+            image_bytes = normalize_image(image_bytes, max_edge, output_format, quality)
+        except Exception:
+            # Keep the original; describe_image decides whether it is usable at all
+            pass
+    return image_bytes, describe_image(image_bytes)
+
+
+async def ingest_image_bytes(image_bytes: bytes, normalize: bool = True) -> tuple:
+    """
+    Validate, normalize and describe an incoming image once, in the process pool.
+    Returns (image_bytes, metadata); images Pillow cannot read are rejected with a 400.
+    """
+    try:
+        with tryon_stage("image_ingest"):
+            ingested_bytes, metadata = await run_in_image_process_pool(
+                ingest_image,
+                image_bytes,
+                IMAGE_MAX_EDGE if normalize else 0,
+                IMAGE_NORMALIZE_FORMAT,
+                IMAGE_NORMALIZE_QUALITY
+            )
+    except Exception as e:
+        logger.warning(f"Rejected unreadable image ({len(image_bytes)} bytes): {e}")
+        raise HTTPException(status_code=400, detail="Image could not be read, upload a JPEG, PNG, WebP or GIF image")
+    
+    if ingested_bytes != image_bytes:
+        logger.info(f"Normalized image from {len(image_bytes)} to {len(ingested_bytes)} bytes")
+    return ingested_bytes, metadata
+
+
+# Image Variant Configuration
+# Longest edge in pixels of each derivative served by the image endpoints; "full" is the stored image
+IMAGE_VARIANTS = {"thumbnail": 256, "medium": 768, "full": None}
+IMAGE_VARIANT_QUALITY = 85
+# Stored images never change for a given try-on or upload, so clients and proxies may cache them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+async def load_image_variant(source_ref: str, source_image_bytes_loader, variant: str) -> bytes:
+    """
+    Return the requested variant of an image, rendering and storing it on first use
+    """
+    max_edge = IMAGE_VARIANTS[variant]
+    if max_edge is None:
+        return await source_image_bytes_loader()
+    
+    existing = await db.image_variants.find_one(
+        {"source_ref": source_ref, "variant": variant},
+        {"_id": 0, "ref": 1}
+    )
+    if existing:
+        try:
+            return await blob_store.get(existing["ref"])
+        except KeyError:
+            logger.warning(f"Image variant {variant} of {source_ref[:12]} missing from blob store, rendering again")
+    
+    source_image_bytes = await source_image_bytes_loader()
+    variant_bytes = await run_in_image_process_pool(
+        normalize_image,
+        source_image_bytes,
+        max_edge,
+        "JPEG",
+        IMAGE_VARIANT_QUALITY
+    )
+    variant_ref = await blob_store.put(variant_bytes)
+    await db.image_variants.update_one(
+        {"source_ref": source_ref, "variant": variant},
+        {"$set": {"ref": variant_ref, "size": len(variant_bytes), "created_at": datetime.utcnow()}},
+        upsert=True
+    )
+    logger.info(f"Rendered {variant} variant of {source_ref[:12]} ({len(variant_bytes)} bytes)")
+    return variant_bytes
+
+
+async def serve_image_variant(http_request: Request, record: dict, ref_field: str, legacy_field: str, variant: str) -> Response:
+    """
+    Binary image response with a strong ETag and immutable caching.
+    Conditional requests are answered with 304 before any image bytes are loaded.
+    """
+    if variant not in IMAGE_VARIANTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown variant '{variant}', expected one of: {', '.join(IMAGE_VARIANTS)}"
+        )
+    
+    source_ref = record.get(ref_field)
+    legacy_image_bytes = None
+    if not source_ref:
+        # Records from before the blob store carry the image inline; derive the same content hash
+        legacy_image_bytes = await decode_base64_image(record[legacy_field])
+        source_ref = BlobStore.compute_ref(legacy_image_bytes)
+    
+    etag = f'"{source_ref}-{variant}"'
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    
+    if_none_match = http_request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    
+    async def load_source():
+        if legacy_image_bytes is not None:
+            return legacy_image_bytes
+        return await blob_store.get(source_ref)
+    
+    image_bytes = await load_image_variant(source_ref, load_source, variant)
+    return Response(content=image_bytes, media_type=detect_mime_type(image_bytes), headers=headers)
+
+
+# Try-on Result Cache Configuration
+# Size is measured in bytes of cached result images; entries also expire after the TTL
+TRYON_CACHE_MAX_BYTES = int(os.environ.get("TRYON_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+TRYON_CACHE_TTL_SECONDS = int(os.environ.get("TRYON_CACHE_TTL_SECONDS", "3600"))
+
+tryon_result_cache = TTLCache(
+    maxsize=TRYON_CACHE_MAX_BYTES,
+    ttl=TRYON_CACHE_TTL_SECONDS,
+    getsizeof=len
+)
+tryon_cache_stats = {"hits": 0, "misses": 0, "bypassed": 0, "coalesced": 0}
+
+# Running generations by cache key; identical concurrent requests wait on the same task
+tryon_generations_in_flight = {}
+# Callers still waiting on each running generation; it is cancelled when the last one goes away
+tryon_generation_waiters = {}
+
+
+def compute_tryon_cache_key(image_sha256s: List[str], prompt: str, model: str, aspect_ratio: str) -> str:
+    """
+    Content digest identifying a try-on generation, built from the image hashes recorded at ingestion
+    (person first, then garments in order).
+    Every component is length-prefixed so different inputs can never collide by concatenation.
+    """
+    digest = hashlib.sha256()
+    for component in (*image_sha256s, prompt, model, aspect_ratio):
+        encoded = component.encode("utf-8")
+        digest.update(len(encoded).to_bytes(8, "big"))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+def store_cached_tryon_result(cache_key: str, result_image_bytes: bytes):
+    """
+    Store a generated result, skipping results too large to ever fit in the cache
+    """
+    if len(result_image_bytes) > tryon_result_cache.maxsize:
+        logger.warning(f"Try-on result of {len(result_image_bytes)} bytes exceeds cache size, not caching")
+        return
+    tryon_result_cache[cache_key] = result_image_bytes
+
+
+# Blob Store Configuration
+# "gridfs" keeps image bytes in MongoDB GridFS, "local" in a content-addressed directory
+BLOB_STORE_BACKEND = os.environ.get("BLOB_STORE_BACKEND", "gridfs")
+BLOB_STORE_DIR = Path(os.environ.get("BLOB_STORE_DIR", str(ROOT_DIR / "blobs")))
+
+
+class BlobStore(ABC):
+    """
+    Stores each image once as raw bytes, keyed by the SHA-256 hash of its content.
+    Documents only keep the returned reference.
+    """
+    
+    @staticmethod
+    def compute_ref(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+    
+    @abstractmethod
+    async def put(self, data: bytes) -> str:
+        ...
+    
+    @abstractmethod
+    async def get(self, ref: str) -> bytes:
+        """Return the stored bytes, raising KeyError if the reference is unknown"""
+    
+    @abstractmethod
+    def list_blobs(self):
+        """Async iterator of {"ref", "size", "stored_at"} for every stored blob, used by garbage collection"""
+    
+    @abstractmethod
+    async def delete(self, ref: str):
+        ...
+    
+    async def put_stream(self, chunks) -> tuple:
+        """
+        Store bytes arriving as an async iterator of chunks. Returns (ref, size).
+        Backends that can write incrementally override this to avoid buffering the whole image.
+        """
+        buffer = bytearray()
+        async for chunk in chunks:
+            buffer.extend(chunk)
+        data = bytes(buffer)
+        return await self.put(data), len(data)
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, root: Path):
+        self.root = root
+    
+    def _path(self, ref: str) -> Path:
+        return self.root / ref[:2] / ref
+    
+    def _write(self, ref: str, data: bytes):
+        path = self._path(ref)
+        if path.exists():
+            # Storing a blob again counts as new for the garbage collection grace period
+            os.utime(path)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary name first so readers never see a partial blob
+        tmp_path = path.with_name(f"{ref}.{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    
+    def _read(self, ref: str) -> bytes:
+        try:
+            return self._path(ref).read_bytes()
+        except FileNotFoundError:
+            raise KeyError(ref)
+    
+    async def put(self, data: bytes) -> str:
+        ref = self.compute_ref(data)
+        await asyncio.to_thread(self._write, ref, data)
+        return ref
+    
+    async def get(self, ref: str) -> bytes:
+        return await asyncio.to_thread(self._read, ref)
+    
+    def _commit(self, tmp_path: Path, ref: str):
+        path = self._path(ref)
+        if path.exists():
+            tmp_path.unlink()
+            os.utime(path)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, path)
+    
+    async def put_stream(self, chunks) -> tuple:
+        # The hash is only known at the end, so stream into a temporary file and move it into place
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.root / f"upload.{uuid.uuid4().hex}.tmp"
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as tmp_file:
+                async for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    await asyncio.to_thread(tmp_file.write, chunk)
+            ref = digest.hexdigest()
+            await asyncio.to_thread(self._commit, tmp_path, ref)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        return ref, size
+    
+    def _scan(self) -> List[dict]:
+        blobs = []
+        if not self.root.exists():
+            return blobs
+        for path in self.root.glob("??/*"):
+            # Temporary files are removed by the writer itself
+            if path.suffix == ".tmp":
+                continue
+            stat = path.stat()
+            blobs.append({"ref": path.name, "size": stat.st_size, "stored_at": datetime.utcfromtimestamp(stat.st_mtime)})
+        return blobs
+    
+    async def list_blobs(self):
+        for blob in await asyncio.to_thread(self._scan):
+            yield blob
+    
+    async def delete(self, ref: str):
+        await asyncio.to_thread(self._path(ref).unlink, missing_ok=True)
+
+
+class GridFSBlobStore(BlobStore):
+    def __init__(self, database, bucket_name: str = "images"):
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name=bucket_name)
+        self.files = database[f"{bucket_name}.files"]
+    
+    async def _refresh(self, ref: str) -> bool:
+        """
+        Mark an existing blob as just stored, for the garbage collection grace period. Returns False if it is not stored.
+        """
+        result = await self.files.update_many({"filename": ref}, {"$set": {"uploadDate": datetime.utcnow()}})
+        return result.matched_count > 0
+    
+    async def put(self, data: bytes) -> str:
+        ref = self.compute_ref(data)
+        if not await self._refresh(ref):
+            await self.bucket.upload_from_stream(ref, data)
+        return ref
+    
+    async def get(self, ref: str) -> bytes:
+        try:
+            stream = await self.bucket.open_download_stream_by_name(ref)
+        except NoFile:
+            raise KeyError(ref)
+        return await stream.read()
+    
+    async def put_stream(self, chunks) -> tuple:
+        # Write chunks straight to GridFS under a temporary name, then rename or drop the duplicate
+        grid_in = self.bucket.open_upload_stream(f"upload.{uuid.uuid4().hex}.tmp")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                await grid_in.write(chunk)
+            await grid_in.close()
+        except BaseException:
+            await grid_in.abort()
+            raise
+        
+        ref = digest.hexdigest()
+        if await self._refresh(ref):
+            await self.bucket.delete(grid_in._id)
+        else:
+            await self.bucket.rename(grid_in._id, ref)
+        return ref, size
+    
+    async def list_blobs(self):
+        # Includes temporary uploads left behind by a crash; they are unreferenced and collected like any other blob
+        async for grid_file in self.files.find({}, {"filename": 1, "length": 1, "uploadDate": 1}):
+            yield {"ref": grid_file["filename"], "size": grid_file["length"], "stored_at": grid_file["uploadDate"]}
+    
+    async def delete(self, ref: str):
+        async for grid_file in self.files.find({"filename": ref}, {"_id": 1}):
+            try:
+                await self.bucket.delete(grid_file["_id"])
+            except NoFile:
+                pass
+
+
+def create_blob_store() -> BlobStore:
+    if BLOB_STORE_BACKEND == "local":
+        return LocalBlobStore(BLOB_STORE_DIR)
+    if BLOB_STORE_BACKEND == "gridfs":
+        return GridFSBlobStore(db)
+    raise ValueError(f"Unknown BLOB_STORE_BACKEND: {BLOB_STORE_BACKEND}")
+
+
+blob_store = create_blob_store()
+
+
+async def load_image_bytes(record: dict, ref_field: str, legacy_field: str) -> bytes:
+    """
+    Load an image referenced by a document.
+    Records written before the blob store keep the image inline as base64 under legacy_field.
+    """
+    ref = record.get(ref_field)
+    if ref:
+        return await blob_store.get(ref)
+    return await decode_base64_image(record[legacy_field])
+
+
+# Retention Configuration
+# Upload records expire this many hours after they were uploaded or last used in a try-on (0 keeps them forever).
+# Try-on records keep their own image references, so an expired upload never breaks an existing try-on.
+UPLOAD_RETENTION_HOURS = float(os.environ.get("UPLOAD_RETENTION_HOURS", "72"))
+# Try-ons without feedback older than this many days are moved to gzip archives (0 disables archival)
+TRYON_ARCHIVE_AFTER_DAYS = float(os.environ.get("TRYON_ARCHIVE_AFTER_DAYS", "0"))
+TRYON_ARCHIVE_DIR = Path(os.environ.get("TRYON_ARCHIVE_DIR", str(ROOT_DIR / "archive")))
+# Embed the images in the archive so it stays readable without the blob store
+TRYON_ARCHIVE_INCLUDE_IMAGES = os.environ.get("TRYON_ARCHIVE_INCLUDE_IMAGES", "true").lower() == "true"
+TRYON_ARCHIVE_BATCH_SIZE = int(os.environ.get("TRYON_ARCHIVE_BATCH_SIZE", "500"))
+RETENTION_SWEEP_INTERVAL_SECONDS = float(os.environ.get("RETENTION_SWEEP_INTERVAL_SECONDS", str(6 * 60 * 60)))
+# Every sweep also deletes blobs no upload, try-on or image variant references any more (expired uploads,
+# archived try-ons). Blobs stored within the grace period are kept, since the request that stored one may
+# not have inserted its document yet.
+BLOB_GC_ENABLED = os.environ.get("BLOB_GC_ENABLED", "true").lower() == "true"
+BLOB_GC_GRACE_SECONDS = float(os.environ.get("BLOB_GC_GRACE_SECONDS", "3600"))
+
+# Document fields holding blob references; a field may hold one reference or a list
+BLOB_REFERENCE_FIELDS = {
+    "uploads": ("image_ref",),
+    "tryons": ("person_image_ref", "clothing_image_ref", "clothing_image_refs", "result_image_ref")
+}
+
+retention_task = None
+retention_lock = asyncio.Lock()
+retention_stats = {
+    "last_run_at": None,
+    "last_run": None,
+    "total_archived_tryons": 0,
+    "total_deleted_blobs": 0,
+    "total_freed_blob_bytes": 0,
+    "total_reclaimed_bytes": 0,
+    "total_archive_bytes": 0
+}
+
+
+def upload_expiry_fields() -> dict:
+    if UPLOAD_RETENTION_HOURS <= 0:
+        return {}
+    return {"expires_at": datetime.utcnow() + timedelta(hours=UPLOAD_RETENTION_HOURS)}
+
+
+async def touch_uploads(upload_ids: List[str]):
+    """
+    Push back the expiry of uploads that are being used, so active sessions keep their images
+    """
+    now = datetime.utcnow()
+    update = {"$set": {"last_used_at": now}}
+    if UPLOAD_RETENTION_HOURS > 0:
+        update["$set"]["expires_at"] = now + timedelta(hours=UPLOAD_RETENTION_HOURS)
+    await db.uploads.update_many({"upload_id": {"$in": upload_ids}}, update)
+
+
+def write_archive_file(path: Path, lines: List[str]) -> int:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as archive_file:
+        for line in lines:
+            archive_file.write(line)
+            archive_file.write("\n")
+    os.replace(tmp_path, path)
+    return path.stat().st_size
+
+
+async def archive_tryon_batch(cutoff: datetime) -> Optional[dict]:
+    """
+    Move one batch of old try-ons without feedback to a gzip JSON Lines archive file.
+    Returns None when nothing is left to archive.
+    """
+    eligible = {
+        "timestamp": {"$lt": cutoff},
+        "feedback": {"$exists": False},
+        "status": {"$in": ["completed", "failed"]}
+    }
+    tryons = await db.tryons.find(eligible).sort("timestamp", 1).limit(TRYON_ARCHIVE_BATCH_SIZE).to_list(TRYON_ARCHIVE_BATCH_SIZE)
+    if not tryons:
+        return None
+    
+    lines = []
+    document_sizes = {}
+    for tryon in tryons:
+        document_sizes[tryon["id"]] = len(BSON.encode(tryon))
+        tryon.pop("_id")
+        if TRYON_ARCHIVE_INCLUDE_IMAGES:
+            for image_field in ("person_image", "clothing_image", "result_image"):
+                ref = tryon.get(f"{image_field}_ref")
+                if ref and image_field not in tryon:
+                    try:
+                        tryon[image_field] = await encode_base64_image(await blob_store.get(ref))
+                    except KeyError:
+                        logger.warning(f"Blob {ref[:12]} of try-on {tryon['id']} is missing, archiving reference only")
+            if tryon.get("clothing_image_refs"):
+                # Outfit try-ons reference every garment
+                try:
+                    tryon["clothing_images"] = [
+                        await encode_base64_image(await blob_store.get(ref))
+                        for ref in tryon["clothing_image_refs"]
+                    ]
+                except KeyError:
+                    logger.warning(f"A garment blob of try-on {tryon['id']} is missing, archiving references only")
+        lines.append(await run_in_cpu_executor(json_util.dumps, tryon))
+    
+    archive_path = TRYON_ARCHIVE_DIR / f"tryons-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.jsonl.gz"
+    archive_bytes = await asyncio.to_thread(write_archive_file, archive_path, lines)
+    
+    # Only delete once the archive file is safely on disk, and only what is still eligible:
+    # feedback may have arrived while the batch was being archived
+    result = await db.tryons.delete_many({"id": {"$in": list(document_sizes)}, **eligible})
+    if result.deleted_count < len(tryons):
+        # The archive still holds a copy of them, which is harmless, but they reclaimed nothing
+        kept = await db.tryons.find({"id": {"$in": list(document_sizes)}}, {"id": 1, "_id": 0}).to_list(None)
+        for tryon in kept:
+            document_sizes.pop(tryon["id"], None)
+        logger.info(f"{len(kept)} try-ons got feedback while archiving and were kept")
+    document_bytes = sum(document_sizes.values())
+    logger.info(f"Archived {result.deleted_count} try-ons to {archive_path.name} ({document_bytes} document bytes)")
+    
+    # Their images are freed by the blob garbage collection that follows, unless something else still uses them
+    return {"archived": result.deleted_count, "document_bytes": document_bytes, "archive_bytes": archive_bytes}
+
+
+async def collect_referenced_blobs() -> set:
+    """
+    Mark phase: every blob reference held by an upload, a try-on, or a variant of a referenced image.
+    Variants of images nobody references any more are deleted along the way.
+    """
+    referenced = set()
+    for collection_name, fields in BLOB_REFERENCE_FIELDS.items():
+        projection = {"_id": 0, **{field: 1 for field in fields}}
+        async for document in db[collection_name].find({}, projection):
+            for field in fields:
+                value = document.get(field)
+                if isinstance(value, list):
+                    referenced.update(value)
+                elif value:
+                    referenced.add(value)
+    
+    orphaned_variants = []
+    async for variant in db.image_variants.find({}, {"_id": 1, "source_ref": 1, "ref": 1}):
+        if variant["source_ref"] in referenced:
+            referenced.add(variant["ref"])
+        else:
+            orphaned_variants.append(variant["_id"])
+    if orphaned_variants:
+        await db.image_variants.delete_many({"_id": {"$in": orphaned_variants}})
+    
+    return referenced
+
+
+async def collect_blob_garbage() -> dict:
+    """
+    Delete blobs that no document references and that are older than the grace period
+    """
+    referenced = await collect_referenced_blobs()
+    cutoff = datetime.utcnow() - timedelta(seconds=BLOB_GC_GRACE_SECONDS)
+    report = {"scanned_blobs": 0, "deleted_blobs": 0, "freed_blob_bytes": 0}
+    
+    async for blob in blob_store.list_blobs():
+        report["scanned_blobs"] += 1
+        if blob["ref"] in referenced or blob["stored_at"] >= cutoff:
+            continue
+        await blob_store.delete(blob["ref"])
+        report["deleted_blobs"] += 1
+        report["freed_blob_bytes"] += blob["size"]
+    
+    if report["deleted_blobs"]:
+        logger.info(f"Blob garbage collection deleted {report['deleted_blobs']} blobs ({report['freed_blob_bytes']} bytes)")
+    return report
+
+
+async def run_retention_sweep() -> dict:
+    """
+    Archive every eligible try-on, then delete unreferenced blobs, and report what was reclaimed.
+    Sweeps run one at a time, so a manual run never archives or collects alongside the background loop.
+    """
+    async with retention_lock:
+        report = {
+            "archived_tryons": 0,
+            "document_bytes": 0,
+            "archive_bytes": 0,
+            "archive_files": 0,
+            "scanned_blobs": 0,
+            "deleted_blobs": 0,
+            "freed_blob_bytes": 0
+        }
+        if TRYON_ARCHIVE_AFTER_DAYS > 0:
+            cutoff = datetime.utcnow() - timedelta(days=TRYON_ARCHIVE_AFTER_DAYS)
+            while True:
+                batch = await archive_tryon_batch(cutoff)
+                if batch is None:
+                    break
+                report["archived_tryons"] += batch["archived"]
+                report["document_bytes"] += batch["document_bytes"]
+                report["archive_bytes"] += batch["archive_bytes"]
+                report["archive_files"] += 1
+        
+        if BLOB_GC_ENABLED:
+            report.update(await collect_blob_garbage())
+        report["reclaimed_bytes"] = report["document_bytes"] + report["freed_blob_bytes"]
+        
+        retention_stats["last_run_at"] = datetime.utcnow()
+        retention_stats["last_run"] = report
+        retention_stats["total_archived_tryons"] += report["archived_tryons"]
+        retention_stats["total_deleted_blobs"] += report["deleted_blobs"]
+        retention_stats["total_freed_blob_bytes"] += report["freed_blob_bytes"]
+        retention_stats["total_reclaimed_bytes"] += report["reclaimed_bytes"]
+        retention_stats["total_archive_bytes"] += report["archive_bytes"]
+        return report
+
+
+async def retention_loop():
+    while True:
+        try:
+            report = await run_retention_sweep()
+            if report["archived_tryons"] or report["deleted_blobs"]:
+                logger.info(
+                    f"Retention sweep archived {report['archived_tryons']} try-ons and deleted {report['deleted_blobs']} blobs, "
+                    f"reclaimed {report['reclaimed_bytes']} bytes"
+                )
+        except Exception as e:
+            logger.error(f"Retention sweep failed: {str(e)}", exc_info=True)
+        await asyncio.sleep(RETENTION_SWEEP_INTERVAL_SECONDS)
+
+
+# Upload Configuration
+# Binary uploads are read in chunks and rejected with 413 once they exceed the cap
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Room for multipart boundaries, part headers and form fields on top of the image bytes
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+async def iter_upload_file(upload: UploadFile):
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def cap_upload_chunks(chunks):
+    """
+    Pass chunks through, raising 413 as soon as the total exceeds MAX_UPLOAD_BYTES
+    """
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Image exceeds the maximum upload size of {MAX_UPLOAD_BYTES} bytes"
+            )
+        yield chunk
+
+
+async def read_upload_chunks(chunks) -> bytes:
+    buffer = bytearray()
+    async for chunk in cap_upload_chunks(chunks):
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+
+async def read_upload_file(upload: UploadFile) -> bytes:
+    return await read_upload_chunks(iter_upload_file(upload))
+
+
+async def iter_multipart_file(http_request: Request, field_name: str):
+    """
+    Yield the bytes of one file field of a multipart/form-data body as they arrive.
+    Unlike request.form(), nothing is spooled to a temporary file. Raises 400 when the field is missing.
+    """
+    _, options = parse_options_header(http_request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if not boundary:
+        raise HTTPException(status_code=400, detail="Multipart upload is missing its boundary")
+    
+    part = {"header_field": b"", "header_value": b"", "headers": {}, "is_field": False}
+    found = False
+    received = []
+    
+    def on_part_begin():
+        part.update(header_field=b"", header_value=b"", headers={}, is_field=False)
+    
+    def on_header_field(data, start, end):
+        part["header_field"] += data[start:end]
+    
+    def on_header_value(data, start, end):
+        part["header_value"] += data[start:end]
+    
+    def on_header_end():
+        part["headers"][part["header_field"].lower()] = part["header_value"]
+        part["header_field"] = part["header_value"] = b""
+    
+    def on_headers_finished():
+        nonlocal found
+        _, disposition = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        # Only the first file sent under field_name is used
+        part["is_field"] = not found and disposition.get(b"name") == field_name.encode() and b"filename" in disposition
+        found = found or part["is_field"]
+    
+    def on_part_data(data, start, end):
+        if part["is_field"]:
+            received.append(data[start:end])
+    
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data
+    })
+    async for chunk in http_request.stream():
+        parser.write(chunk)
+        if received:
+            yield b"".join(received)
+            received.clear()
+    parser.finalize()
+    
+    if not found:
+        raise HTTPException(status_code=400, detail=f"Multipart upload must include an '{field_name}' file field")
+
+
+def request_body_limit(path: str) -> Optional[int]:
+    """
+    Largest request body accepted by the binary endpoints, None for every other route
+    """
+    if path in ("/api/upload/person/binary", "/api/upload/clothing/binary"):
+        return MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES
+    if path == "/api/tryon/binary":
+        return (1 + TRYON_MAX_GARMENTS) * MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES
+    return None
+
+
+class RequestBodyLimitMiddleware:
+    """
+    Cap the request body of the binary endpoints while it is received, before anything parses, buffers or
+    spools it. Declared oversized bodies are rejected up front; chunked bodies without a Content-Length
+    fail with 413 as soon as they pass the limit.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        limit = request_body_limit(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        
+        detail = f"Request body exceeds the maximum upload size of {limit} bytes"
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > limit:
+            await JSONResponse(status_code=413, content={"detail": detail})(scope, receive, send)
+            return
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+
+# Try-on Job Configuration
+# Number of background workers running queued try-on generations concurrently
+TRYON_JOB_WORKERS = int(os.environ.get("TRYON_JOB_WORKERS", "4"))
+
+tryon_job_queue = asyncio.Queue()
+tryon_job_worker_tasks = []
+
+# Batch try-on limits: garments per request and generations running at once for a single batch
+TRYON_BATCH_MAX_ITEMS = int(os.environ.get("TRYON_BATCH_MAX_ITEMS", "15"))
+TRYON_BATCH_CONCURRENCY = int(os.environ.get("TRYON_BATCH_CONCURRENCY", "4"))
+
 
 # N8N Webhook Configuration
 N8N_WEBHOOK_URL = os.environ.get("N8N_WEBHOOK_URL", "https://spantra.app.n8n.cloud/webhook/upload")
 
+# Webhook Outbox Configuration
+# Deliveries are persisted in db.webhook_outbox and retried with exponential backoff until
+# WEBHOOK_MAX_ATTEMPTS is reached, after which they are kept in the "dead" state
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", "8"))
+WEBHOOK_RETRY_BASE_SECONDS = float(os.environ.get("WEBHOOK_RETRY_BASE_SECONDS", "5"))
+WEBHOOK_RETRY_MAX_SECONDS = float(os.environ.get("WEBHOOK_RETRY_MAX_SECONDS", "900"))
+WEBHOOK_DISPATCH_CONCURRENCY = int(os.environ.get("WEBHOOK_DISPATCH_CONCURRENCY", "4"))
+WEBHOOK_POLL_INTERVAL_SECONDS = float(os.environ.get("WEBHOOK_POLL_INTERVAL_SECONDS", "5"))
+# A delivery claimed by a process that died is picked up again after this long
+WEBHOOK_LOCK_SECONDS = 120
+# On shutdown, deliveries in flight get this long to finish; the rest are retried after WEBHOOK_LOCK_SECONDS
+WEBHOOK_SHUTDOWN_GRACE_SECONDS = float(os.environ.get("WEBHOOK_SHUTDOWN_GRACE_SECONDS", "10"))
+
+# "inline" sends the three images as base64 (the original array format),
+# "reference" sends signed, expiring URLs to /api/images/{ref} instead
+N8N_WEBHOOK_PAYLOAD_MODE = os.environ.get("N8N_WEBHOOK_PAYLOAD_MODE", "inline")
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "").rstrip("/")
+
+# Signed Image URL Configuration
+# Use the same secret on every backend instance, otherwise URLs only verify on the instance that signed them
+IMAGE_URL_SIGNING_SECRET = os.environ.get("IMAGE_URL_SIGNING_SECRET") or secrets.token_hex(32)
+IMAGE_URL_TTL_SECONDS = int(os.environ.get("IMAGE_URL_TTL_SECONDS", str(24 * 60 * 60)))
+
+
+def sign_image_ref(image_ref: str, expires: int) -> str:
+    message = f"{image_ref}:{expires}".encode("utf-8")
+    return hmac.new(IMAGE_URL_SIGNING_SECRET.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+def build_signed_image_url(image_ref: str, expires: int) -> str:
+    return f"{PUBLIC_BASE_URL}/api/images/{image_ref}?expires={expires}&signature={sign_image_ref(image_ref, expires)}"
+
+
+webhook_http_client = None
+webhook_dispatcher_task = None
+webhook_delivery_tasks = set()
+webhook_wakeup = asyncio.Event()
+webhook_stats = {"enqueued": 0, "delivered": 0, "failed_attempts": 0, "dead_lettered": 0}
+
+
+def get_webhook_http_client() -> httpx.AsyncClient:
+    """
+    Shared, connection-pooled client for all webhook deliveries
+    """
+    global webhook_http_client
+    if webhook_http_client is None:
+        webhook_http_client = httpx.AsyncClient(timeout=30.0)
+    return webhook_http_client
+
+
+def build_n8n_payload(person_image_base64: str, clothing_images_base64: List[str], result_image_base64: str, tryon_id: str) -> dict:
+    """
+    Inline payload with one "clothing" entry per garment; position orders an outfit's garments, innermost first
+    """
+    return {
+        "tryon_id": tryon_id,
+        "timestamp": datetime.utcnow().isoformat(),
+        "images": [
+            {
+                "type": "person",
+                "data": person_image_base64
+            },
+            *[
+                {
+                    "type": "clothing",
+                    "position": position,
+                    "data": clothing_image_base64
+                }
+                for position, clothing_image_base64 in enumerate(clothing_images_base64)
+            ],
+            {
+                "type": "result",
+                "data": result_image_base64
+            }
+        ]
+    }
+
+
+async def post_to_n8n_webhook(payload: dict):
+    """
+    POST a payload to the n8n webhook, raising on any transport or HTTP error
+    """
+    response = await get_webhook_http_client().post(N8N_WEBHOOK_URL, json=payload)
+    response.raise_for_status()
+    logger.info(f"Successfully sent data to n8n webhook. Status: {response.status_code}")
+
+
 async def send_to_n8n_webhook(person_image_base64: str, clothing_image_base64: str, result_image_base64: str, tryon_id: str):
     """
-    Send try-on images to n8n webhook
-    This function fails silently to not interrupt the try-on process
+    Send try-on images to n8n webhook
+    This function fails silently to not interrupt the try-on process
+    """
+    try:
+        logger.info(f"Sending try-on data to n8n webhook for tryon_id: {tryon_id}")
+        
+        payload = build_n8n_payload(person_image_base64, [clothing_image_base64], result_image_base64, tryon_id)
+        await post_to_n8n_webhook(payload)
+            
+    except httpx.HTTPError as e:
+        logger.error(f"HTTP error sending to n8n webhook: {str(e)}")
+    except Exception as e:
+        logger.error(f"Unexpected error sending to n8n webhook: {str(e)}")
+
+
+def build_n8n_reference_payload(person_image_ref: str, clothing_image_refs: List[str], result_image_ref: str, tryon_id: str) -> dict:
+    """
+    Compact payload pointing n8n at signed image URLs instead of inlining the images
+    """
+    expires = int(time.time()) + IMAGE_URL_TTL_SECONDS
+    
+    def image_entry(image_type: str, image_ref: str) -> dict:
+        return {"type": image_type, "ref": image_ref, "url": build_signed_image_url(image_ref, expires)}
+    
+    return {
+        "tryon_id": tryon_id,
+        "timestamp": datetime.utcnow().isoformat(),
+        "payload_mode": "reference",
+        "expires_at": datetime.utcfromtimestamp(expires).isoformat(),
+        "images": [
+            image_entry("person", person_image_ref),
+            *[
+                {**image_entry("clothing", clothing_image_ref), "position": position}
+                for position, clothing_image_ref in enumerate(clothing_image_refs)
+            ],
+            image_entry("result", result_image_ref)
+        ]
+    }
+
+
+async def build_tryon_webhook_payload(tryon_id: str) -> dict:
+    """
+    Build the n8n payload for a stored try-on from its blob references
+    """
+    tryon = await db.tryons.find_one(
+        {"id": tryon_id},
+        {"_id": 0, "person_image_ref": 1, "clothing_image_ref": 1, "clothing_image_refs": 1, "result_image_ref": 1,
+         "person_image": 1, "clothing_image": 1, "result_image": 1}
+    )
+    if not tryon:
+        raise LookupError(f"Try-on not found: {tryon_id}")
+    
+    # Outfit try-ons list every garment; single-garment ones only have clothing_image_ref
+    clothing_image_refs = tryon.get("clothing_image_refs") or [tryon.get("clothing_image_ref")]
+    
+    # Records from before the blob store have no refs to sign and always go inline
+    ref_fields = ("person_image_ref", "clothing_image_ref", "result_image_ref")
+    if N8N_WEBHOOK_PAYLOAD_MODE == "reference" and all(tryon.get(field) for field in ref_fields):
+        return build_n8n_reference_payload(tryon["person_image_ref"], clothing_image_refs, tryon["result_image_ref"], tryon_id)
+    
+    if tryon.get("clothing_image_refs"):
+        clothing_loaders = [blob_store.get(ref) for ref in clothing_image_refs]
+    else:
+        clothing_loaders = [load_image_bytes(tryon, "clothing_image_ref", "clothing_image")]
+    person_image_bytes, result_image_bytes, *clothing_image_bytes = await asyncio.gather(
+        load_image_bytes(tryon, "person_image_ref", "person_image"),
+        load_image_bytes(tryon, "result_image_ref", "result_image"),
+        *clothing_loaders
+    )
+    person_image_base64, result_image_base64, *clothing_images_base64 = await asyncio.gather(
+        encode_base64_image(person_image_bytes),
+        encode_base64_image(result_image_bytes),
+        *[encode_base64_image(image_bytes) for image_bytes in clothing_image_bytes]
+    )
+    return build_n8n_payload(person_image_base64, clothing_images_base64, result_image_base64, tryon_id)
+
+
+async def enqueue_tryon_webhook(tryon_id: str):
+    """
+    Record a pending n8n delivery for a completed try-on and wake the dispatcher
+    """
+    now = datetime.utcnow()
+    await db.webhook_outbox.insert_one({
+        "id": str(uuid.uuid4()),
+        "tryon_id": tryon_id,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now,
+        "updated_at": now
+    })
+    webhook_stats["enqueued"] += 1
+    webhook_wakeup.set()
+
+
+def webhook_retry_delay(attempts: int) -> float:
+    # Exponential backoff with jitter so a recovering n8n is not hit by every retry at once
+    delay = min(WEBHOOK_RETRY_BASE_SECONDS * (2 ** (attempts - 1)), WEBHOOK_RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+
+async def claim_webhook_delivery():
+    now = datetime.utcnow()
+    return await db.webhook_outbox.find_one_and_update(
+        {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "sending", "locked_until": {"$lte": now}}
+        ]},
+        {"$set": {
+            "status": "sending",
+            "locked_until": now + timedelta(seconds=WEBHOOK_LOCK_SECONDS),
+            "updated_at": now
+        }},
+        sort=[("next_attempt_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def deliver_webhook(entry: dict):
+    """
+    Attempt one delivery and record the outcome on the outbox entry
+    """
+    attempts = entry.get("attempts", 0) + 1
+    logger.info(f"Sending try-on data to n8n webhook for tryon_id: {entry['tryon_id']} (attempt {attempts})")
+    
+    try:
+        with tryon_stage("webhook_delivery"):
+            payload = await build_tryon_webhook_payload(entry["tryon_id"])
+            await post_to_n8n_webhook(payload)
+    except Exception as e:
+        webhook_stats["failed_attempts"] += 1
+        error = f"{type(e).__name__}: {str(e)}"
+        now = datetime.utcnow()
+        
+        # A missing try-on can never be delivered, there is no point in retrying it
+        if attempts >= WEBHOOK_MAX_ATTEMPTS or isinstance(e, LookupError):
+            webhook_stats["dead_lettered"] += 1
+            logger.error(f"Giving up on n8n webhook for tryon_id {entry['tryon_id']} after {attempts} attempts: {error}")
+            update = {"status": "dead", "attempts": attempts, "last_error": error, "updated_at": now}
+        else:
+            delay = webhook_retry_delay(attempts)
+            logger.warning(f"n8n webhook for tryon_id {entry['tryon_id']} failed, retrying in {delay:.0f}s: {error}")
+            update = {
+                "status": "pending",
+                "attempts": attempts,
+                "last_error": error,
+                "next_attempt_at": now + timedelta(seconds=delay),
+                "updated_at": now
+            }
+    else:
+        webhook_stats["delivered"] += 1
+        now = datetime.utcnow()
+        update = {"status": "delivered", "attempts": attempts, "delivered_at": now, "updated_at": now}
+    
+    await db.webhook_outbox.update_one({"id": entry["id"]}, {"$set": update, "$unset": {"locked_until": ""}})
+
+
+# Background Tasks
+# The event loop only keeps weak references to tasks, so fire-and-forget tasks are held here until they finish
+background_tasks = set()
+
+
+def start_background_task(coro, tasks: set = background_tasks) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+
+async def stop_background_tasks(tasks: set, timeout: float = 0):
+    """
+    Give running tasks up to timeout seconds to finish, then cancel the rest and wait for them to unwind
+    """
+    if tasks and timeout > 0:
+        await asyncio.wait(set(tasks), timeout=timeout)
+    pending = set(tasks)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def webhook_dispatcher():
+    """
+    Background loop draining the outbox with up to WEBHOOK_DISPATCH_CONCURRENCY deliveries in flight
+    """
+    slots = asyncio.Semaphore(WEBHOOK_DISPATCH_CONCURRENCY)
+    
+    async def run_delivery(entry: dict):
+        try:
+            await deliver_webhook(entry)
+        except Exception as e:
+            logger.error(f"Error recording webhook delivery {entry['id']}: {str(e)}", exc_info=True)
+        finally:
+            slots.release()
+    
+    while True:
+        await slots.acquire()
+        webhook_wakeup.clear()
+        try:
+            entry = await claim_webhook_delivery()
+        except Exception as e:
+            slots.release()
+            logger.error(f"Error claiming webhook delivery: {str(e)}")
+            await asyncio.sleep(WEBHOOK_POLL_INTERVAL_SECONDS)
+            continue
+        
+        if entry is None:
+            slots.release()
+            # Sleep until a new delivery is enqueued or a retry may have become due
+            try:
+                await asyncio.wait_for(webhook_wakeup.wait(), timeout=WEBHOOK_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        
+        start_background_task(run_delivery(entry), webhook_delivery_tasks)
+
+
+# Add your routes to the router instead of directly to app
+@api_router.get("/")
+async def root():
+    return {"message": "Virtual Try-On API is running"}
+
+@api_router.post("/status", response_model=StatusCheck)
+async def create_status_check(input: StatusCheckCreate):
+    status_dict = input.dict()
+    status_obj = StatusCheck(**status_dict)
+    _ = await db.status_checks.insert_one(status_obj.dict())
+    return status_obj
+
+@api_router.get("/status", response_model=List[StatusCheck])
+async def get_status_checks():
+    # Limit status checks to last 100 for performance
+    status_checks = await db.status_checks.find().sort("timestamp", -1).limit(100).to_list(100)
+    return [StatusCheck(**status_check) for status_check in status_checks]
+
+
+@api_router.post("/upload/person", response_model=ImageUploadResponse)
+async def upload_person_image(request: ImageUploadRequest):
+    """
+    Upload person image and get an upload ID for later use
+    """
+    try:
+        logger.info("Uploading person image...")
+        
+        upload_id = str(uuid.uuid4())
+        
+        # Store the normalized image bytes in the blob store and only a reference plus metadata in MongoDB
+        with trace_span("base64_decode"):
+            raw_image_bytes = await decode_request_image(request.image, "image")
+        image_bytes, image_meta = await ingest_image_bytes(raw_image_bytes)
+        with trace_span("blob_store"):
+            image_ref = await blob_store.put(image_bytes)
+        
+        upload_record = {
+            "upload_id": upload_id,
+            "image_type": "person",
+            "image_ref": image_ref,
+            "image_size": len(image_bytes),
+            "image_meta": image_meta,
+            "timestamp": datetime.utcnow(),
+            "status": "uploaded",
+            **upload_expiry_fields()
+        }
+        
+        with trace_span("db_insert"):
+            await db.uploads.insert_one(upload_record)
+        logger.info(f"Person image uploaded with ID: {upload_id}")
+        
+        return build_upload_response(upload_record)
+        
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error uploading person image: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to upload person image: {str(e)}"
+        )
+
+
+@api_router.post("/upload/clothing", response_model=ImageUploadResponse)
+async def upload_clothing_image(request: ImageUploadRequest):
+    """
+    Upload clothing image and get an upload ID for later use
+    """
+    try:
+        logger.info("Uploading clothing image...")
+        
+        upload_id = str(uuid.uuid4())
+        
+        # Store the normalized image bytes in the blob store and only a reference plus metadata in MongoDB
+        with trace_span("base64_decode"):
+            raw_image_bytes = await decode_request_image(request.image, "image")
+        image_bytes, image_meta = await ingest_image_bytes(raw_image_bytes)
+        with trace_span("blob_store"):
+            image_ref = await blob_store.put(image_bytes)
+        
+        upload_record = {
+            "upload_id": upload_id,
+            "image_type": "clothing",
+            "image_ref": image_ref,
+            "image_size": len(image_bytes),
+            "image_meta": image_meta,
+            "timestamp": datetime.utcnow(),
+            "status": "uploaded",
+            **upload_expiry_fields()
+        }
+        
+        with trace_span("db_insert"):
+            await db.uploads.insert_one(upload_record)
+        logger.info(f"Clothing image uploaded with ID: {upload_id}")
+        
+        return build_upload_response(upload_record)
+        
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error uploading clothing image: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to upload clothing image: {str(e)}"
+        )
+
+
+def build_upload_response(upload_record: dict) -> ImageUploadResponse:
+    image_meta = upload_record["image_meta"]
+    return ImageUploadResponse(
+        upload_id=upload_record["upload_id"],
+        timestamp=upload_record["timestamp"],
+        status="uploaded",
+        mime_type=image_meta["mime_type"],
+        width=image_meta["width"],
+        height=image_meta["height"],
+        aspect_ratio=image_meta["aspect_ratio"]
+    )
+
+
+async def store_binary_upload(http_request: Request, image_type: str) -> ImageUploadResponse:
+    """
+    Store an uploaded image in the blob store without base64 or JSON parsing.
+    Accepts multipart/form-data with an "image" file field, or the raw image as the request body.
+    """
+    content_type = http_request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        chunks = iter_multipart_file(http_request, "image")
+    else:
+        chunks = http_request.stream()
+    
+    # The request body itself is capped by RequestBodyLimitMiddleware while it arrives
+    if IMAGE_MAX_EDGE > 0:
+        # Normalization needs the whole image, so it is read into memory (still capped) before storing
+        with trace_span("upload_read"):
+            image_bytes = await read_upload_chunks(chunks)
+        if not image_bytes:
+            raise HTTPException(status_code=400, detail="Uploaded image is empty")
+        image_bytes, image_meta = await ingest_image_bytes(image_bytes)
+        with trace_span("blob_store"):
+            image_ref, image_size = await blob_store.put(image_bytes), len(image_bytes)
+    else:
+        with trace_span("upload_read"):
+            image_ref, image_size = await blob_store.put_stream(cap_upload_chunks(chunks))
+        if image_size == 0:
+            raise HTTPException(status_code=400, detail="Uploaded image is empty")
+        # Streamed straight to storage, so describe it from there once
+        _, image_meta = await ingest_image_bytes(await blob_store.get(image_ref), normalize=False)
+    
+    upload_id = str(uuid.uuid4())
+    
+    upload_record = {
+        "upload_id": upload_id,
+        "image_type": image_type,
+        "image_ref": image_ref,
+        "image_size": image_size,
+        "image_meta": image_meta,
+        "timestamp": datetime.utcnow(),
+        "status": "uploaded",
+        **upload_expiry_fields()
+    }
+    
+    with trace_span("db_insert"):
+        await db.uploads.insert_one(upload_record)
+    logger.info(f"{image_type.capitalize()} image uploaded ({image_size} bytes, binary) with ID: {upload_id}")
+    
+    return build_upload_response(upload_record)
+
+
+@api_router.post("/upload/person/binary", response_model=ImageUploadResponse)
+async def upload_person_image_binary(http_request: Request):
+    """
+    Upload person image as multipart/form-data or raw bytes and get an upload ID for later use
+    """
+    try:
+        logger.info("Uploading person image (binary)...")
+        return await store_binary_upload(http_request, "person")
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error uploading person image: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to upload person image: {str(e)}"
+        )
+
+
+@api_router.post("/upload/clothing/binary", response_model=ImageUploadResponse)
+async def upload_clothing_image_binary(http_request: Request):
+    """
+    Upload clothing image as multipart/form-data or raw bytes and get an upload ID for later use
+    """
+    try:
+        logger.info("Uploading clothing image (binary)...")
+        return await store_binary_upload(http_request, "clothing")
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error uploading clothing image: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to upload clothing image: {str(e)}"
+        )
+
+
+async def load_upload_image(upload: dict, upload_id: str) -> tuple:
+    """
+    Load an upload's image with the metadata stored at ingestion. Returns (image_bytes, metadata).
+    Uploads from before ingestion stored metadata are described once and updated in place.
+    """
+    image_bytes = await load_image_bytes(upload, "image_ref", "image_data")
+    image_meta = upload.get("image_meta")
+    if not image_meta:
+        _, image_meta = await ingest_image_bytes(image_bytes, normalize=False)
+        await db.uploads.update_one({"upload_id": upload_id}, {"$set": {"image_meta": image_meta}})
+    return image_bytes, image_meta
+
+
+def check_garment_count(garment_count: int):
+    if garment_count > TRYON_MAX_GARMENTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"An outfit can contain at most {TRYON_MAX_GARMENTS} garments"
+        )
+
+
+async def resolve_tryon_images(request: TryOnRequest):
+    """
+    Resolve the person and clothing images of a try-on request to (image_bytes, metadata) pairs.
+    Returns (person_image, clothing_images) with the garments in request order.
+    
+    Supports two modes:
+    1. Direct images: person_image and clothing_image (or clothing_images) as base64
+    2. Upload IDs: person_upload_id and clothing_upload_id (or clothing_upload_ids) from previous uploads
+    """
+    clothing_upload_ids = request.clothing_upload_ids or ([request.clothing_upload_id] if request.clothing_upload_id else [])
+    clothing_images = request.clothing_images or ([request.clothing_image] if request.clothing_image else [])
+    
+    if request.person_upload_id and clothing_upload_ids:
+        # Mode 1: Using upload IDs
+        logger.info("Using upload IDs mode")
+        check_garment_count(len(clothing_upload_ids))
+        
+        with tryon_stage("upload_fetch"):
+            # Fetch person image reference from uploads collection (legacy uploads hold image_data inline)
+            person_upload = await db.uploads.find_one(
+                {"upload_id": request.person_upload_id},
+                {"image_ref": 1, "image_data": 1, "image_meta": 1, "_id": 0}
+            )
+            if not person_upload:
+                raise HTTPException(status_code=404, detail=f"Person upload ID not found: {request.person_upload_id}")
+            
+            # Fetch clothing image references from uploads collection (legacy uploads hold image_data inline)
+            clothing_uploads = await db.uploads.find(
+                {"upload_id": {"$in": clothing_upload_ids}},
+                {"upload_id": 1, "image_ref": 1, "image_data": 1, "image_meta": 1, "_id": 0}
+            ).to_list(None)
+            clothing_by_id = {upload["upload_id"]: upload for upload in clothing_uploads}
+            for clothing_upload_id in clothing_upload_ids:
+                if clothing_upload_id not in clothing_by_id:
+                    raise HTTPException(status_code=404, detail=f"Clothing upload ID not found: {clothing_upload_id}")
+            
+            person_image, *clothing_images = await asyncio.gather(
+                load_upload_image(person_upload, request.person_upload_id),
+                *[load_upload_image(clothing_by_id[upload_id], upload_id) for upload_id in clothing_upload_ids]
+            )
+        
+        await touch_uploads([request.person_upload_id, *clothing_upload_ids])
+        
+        logger.info(f"Retrieved images from uploads: person={request.person_upload_id}, clothing={', '.join(clothing_upload_ids)}")
+        return person_image, clothing_images
+    
+    if request.person_image and clothing_images:
+        # Mode 2: Direct images (backward compatibility)
+        logger.info("Using direct images mode")
+        check_garment_count(len(clothing_images))
+        with tryon_stage("base64_decode"):
+            person_image_bytes, *clothing_image_bytes = await asyncio.gather(
+                decode_request_image(request.person_image, "person_image"),
+                *[decode_request_image(clothing_image, "clothing_image") for clothing_image in clothing_images]
+            )
+        person_image, *clothing_images = await asyncio.gather(
+            ingest_image_bytes(person_image_bytes),
+            *[ingest_image_bytes(image_bytes) for image_bytes in clothing_image_bytes]
+        )
+        return person_image, clothing_images
+    
+    raise HTTPException(
+        status_code=400,
+        detail="Must provide either (person_image + clothing_image) OR (person_upload_id + clothing_upload_id)"
+    )
+
+
+async def generate_tryon_result(
+    person_image: tuple,
+    clothing_images: List[tuple],
+    bypass_cache: bool = False,
+    bounded: bool = True
+):
+    """
+    Generate the try-on image with Gemini, serving identical earlier generations from the result cache.
+    Images are (image_bytes, metadata) pairs from ingestion, so nothing is parsed here.
+    Several garments are composed into one outfit in a single generation.
+    Identical requests arriving while a generation runs share it instead of calling Gemini again.
+    Cache misses go through admission control; bounded=False waits for a slot instead of being rejected.
+    Returns (result_image_bytes, cached); cached is also true for a shared generation.
+    """
+    if gemini_pool is None or not gemini_pool.slots:
+        logger.error("GEMINI_API_KEY not found in environment")
+        raise HTTPException(status_code=500, detail="Gemini API key not configured")
+    
+    _, person_meta = person_image
+    prompt = build_tryon_prompt(len(clothing_images))
+    
+    # The output aspect ratio follows the person image
+    target_aspect_ratio = person_meta["aspect_ratio"]
+    logger.info(f"Input dimensions: {person_meta['width']}x{person_meta['height']}. Target Gemini Ratio: {target_aspect_ratio}")
+    logger.info(f"Person image mime type: {person_meta['mime_type']}")
+    logger.info(f"Clothing image mime types: {', '.join(meta['mime_type'] for _, meta in clothing_images)}")
+    
+    # Look up an identical earlier generation before paying for another Gemini call
+    cache_key = compute_tryon_cache_key(
+        [person_meta["sha256"], *[meta["sha256"] for _, meta in clothing_images]],
+        prompt,
+        GEMINI_IMAGE_MODEL,
+        target_aspect_ratio
+    )
+    
+    if bypass_cache:
+        tryon_cache_stats["bypassed"] += 1
+        logger.info("Result cache bypassed for this request")
+    else:
+        cached_result = tryon_result_cache.get(cache_key)
+        if cached_result:
+            tryon_cache_stats["hits"] += 1
+            logger.info(f"Result cache hit for key {cache_key[:12]}")
+            return cached_result, True
+        
+        # An identical generation is already running (double-tap, client retry): wait for its result
+        flight = tryon_generations_in_flight.get(cache_key)
+        if flight is not None:
+            tryon_cache_stats["coalesced"] += 1
+            logger.info(f"Joining in-flight generation for key {cache_key[:12]}")
+            try:
+                with tryon_stage("coalesced_wait"):
+                    return await wait_for_tryon_generation(cache_key, flight), True
+            except HTTPException as he:
+                # A background job waits for admission itself rather than sharing an interactive caller's rejection
+                if bounded or he.status_code not in (429, 503):
+                    raise
+        tryon_cache_stats["misses"] += 1
+    
+    # The generation runs as its own task, so it outlives a disconnecting caller while others still wait on it
+    flight = asyncio.create_task(
+        generate_and_cache_tryon(cache_key, person_image, clothing_images, prompt, target_aspect_ratio, bounded)
+    )
+    tryon_generations_in_flight[cache_key] = flight
+    flight.add_done_callback(lambda task: forget_tryon_generation(cache_key, task))
+    return await wait_for_tryon_generation(cache_key, flight), False
+
+
+async def wait_for_tryon_generation(cache_key: str, flight: asyncio.Task) -> bytes:
+    """
+    Wait on a shared generation, cancelling it when every caller waiting on it has been cancelled
     """
+    tryon_generation_waiters[flight] = tryon_generation_waiters.get(flight, 0) + 1
     try:
-        logger.info(f"Sending try-on data to n8n webhook for tryon_id: {tryon_id}")
-        
-        payload = {
-            "tryon_id": tryon_id,
-            "timestamp": datetime.utcnow().isoformat(),
-            "images": [
-                {
-                    "type": "person",
-                    "data": person_image_base64
-                },
-                {
-                    "type": "clothing",
-                    "data": clothing_image_base64
-                },
-                {
-                    "type": "result",
-                    "data": result_image_base64
-                }
-            ]
-        }
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(N8N_WEBHOOK_URL, json=payload)
-            response.raise_for_status()
-            logger.info(f"Successfully sent data to n8n webhook. Status: {response.status_code}")
-            
-    except httpx.HTTPError as e:
-        logger.error(f"HTTP error sending to n8n webhook: {str(e)}")
-    except Exception as e:
-        logger.error(f"Unexpected error sending to n8n webhook: {str(e)}")
+        return await asyncio.shield(flight)
+    except asyncio.CancelledError:
+        if tryon_generation_waiters[flight] == 1 and not flight.done():
+            logger.info(f"Cancelling generation for key {cache_key[:12]}, no caller is waiting for it")
+            # Later identical requests start afresh instead of joining a generation that is being cancelled
+            if tryon_generations_in_flight.get(cache_key) is flight:
+                del tryon_generations_in_flight[cache_key]
+            flight.cancel()
+        raise
+    finally:
+        tryon_generation_waiters[flight] -= 1
+        if not tryon_generation_waiters[flight]:
+            del tryon_generation_waiters[flight]
 
 
-# Add your routes to the router instead of directly to app
-@api_router.get("/")
-async def root():
-    return {"message": "Virtual Try-On API is running"}
+def forget_tryon_generation(cache_key: str, task: asyncio.Task):
+    if tryon_generations_in_flight.get(cache_key) is task:
+        del tryon_generations_in_flight[cache_key]
+    if not task.cancelled():
+        # Mark the exception as retrieved in case every waiter went away
+        task.exception()
 
-@api_router.post("/status", response_model=StatusCheck)
-async def create_status_check(input: StatusCheckCreate):
-    status_dict = input.dict()
-    status_obj = StatusCheck(**status_dict)
-    _ = await db.status_checks.insert_one(status_obj.dict())
-    return status_obj
 
-@api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    # Limit status checks to last 100 for performance
-    status_checks = await db.status_checks.find().sort("timestamp", -1).limit(100).to_list(100)
-    return [StatusCheck(**status_check) for status_check in status_checks]
+async def generate_and_cache_tryon(
+    cache_key: str,
+    person_image: tuple,
+    clothing_images: List[tuple],
+    prompt: str,
+    target_aspect_ratio: str,
+    bounded: bool
+) -> bytes:
+    """
+    Call Gemini for one try-on generation and cache the result. Returns the result image bytes.
+    """
+    person_image_bytes, person_meta = person_image
+    
+    # Create Part objects for images with correct mime types
+    person_part = types.Part.from_bytes(
+        data=person_image_bytes,
+        mime_type=person_meta["mime_type"]
+    )
+    
+    clothing_parts = [
+        types.Part.from_bytes(data=clothing_image_bytes, mime_type=clothing_meta["mime_type"])
+        for clothing_image_bytes, clothing_meta in clothing_images
+    ]
+    
+    optimized_text_part = types.Part(text=prompt)
+    
+    logger.info(f"Calling Gemini for virtual try-on with {len(clothing_parts)} garment(s)...")
+    
+    # Minimal config - let model use defaults
+    config = types.GenerateContentConfig(
+        response_modalities=["IMAGE"],
+        image_config=types.ImageConfig(
+            aspect_ratio=target_aspect_ratio
+        )
+    )
+    
+    # Create a Content object with all parts
+    content = types.Content(
+        parts=[person_part, *clothing_parts, optimized_text_part]
+    )
+    
+    # Generate content on the least loaded pooled client, once admission control lets us through
+    async with generation_admission.slot(bounded=bounded):
+        with tryon_stage("gemini"):
+            response = await gemini_pool.generate_content(
+                model=GEMINI_IMAGE_MODEL,
+                contents=content,
+                config=config
+            )
+    
+    logger.info("Received response from Gemini")
+    logger.info(f"Response parts: {len(response.parts) if response.parts else 0}")
+    
+    # Find the image part in the response
+    result_image_bytes = None
+    
+    for part in response.parts or []:
+        if part.inline_data is not None:
+            # The data normally comes as bytes; older SDK versions returned base64
+            image_data = part.inline_data.data
+            if isinstance(image_data, bytes):
+                result_image_bytes = image_data
+            else:
+                result_image_bytes = base64.b64decode(image_data)
+            logger.info(f"Found generated image in response. Size: {len(result_image_bytes)} bytes")
+            break
+    
+    if not result_image_bytes:
+        logger.error("No image found in Gemini response")
+        logger.error(f"Response: {response}")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to generate try-on image. No image was returned in the response."
+        )
+    
+    store_cached_tryon_result(cache_key, result_image_bytes)
+    return result_image_bytes
 
 
-@api_router.post("/upload/person", response_model=ImageUploadResponse)
-async def upload_person_image(request: ImageUploadRequest):
+# Try-on Response Negotiation
+# JSON with a base64 result stays the default. Clients that send Accept: image/* get the raw result bytes
+# with metadata in X-Tryon-* headers, and Accept: multipart/mixed gets a JSON metadata part plus a raw image part.
+TRYON_RESPONSE_CONTENT = {
+    "image/png": {"schema": {"type": "string", "format": "binary"}},
+    "multipart/mixed": {"schema": {"type": "string", "format": "binary"}}
+}
+
+
+def parse_accept_header(accept: Optional[str]) -> List[tuple]:
     """
-    Upload person image and get an upload ID for later use
+    Parse an Accept header into (media_range, q) pairs, highest preference first
+    """
+    ranges = []
+    for position, item in enumerate((accept or "").split(",")):
+        params = [param.strip() for param in item.split(";")]
+        media_range = params[0].lower()
+        if not media_range:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ranges.append((media_range, q, position))
+    ranges.sort(key=lambda entry: (-entry[1], entry[2]))
+    return [(media_range, q) for media_range, q, _ in ranges]
+
+
+def negotiate_tryon_media_type(accept: Optional[str], image_mime_type: str) -> str:
+    """
+    Pick the try-on response representation for an Accept header: "json", "image" or "multipart".
+    Wildcards and anything we cannot serve fall back to JSON.
+    """
+    for media_range, q in parse_accept_header(accept):
+        if q <= 0:
+            continue
+        if media_range in ("application/json", "application/*", "*/*"):
+            return "json"
+        if media_range in ("image/*", image_mime_type):
+            return "image"
+        if media_range in ("multipart/mixed", "multipart/*"):
+            return "multipart"
+    return "json"
+
+
+async def build_tryon_response(http_request: Request, tryon_id: str, timestamp: datetime, result_image_bytes: bytes, cached: bool):
+    """
+    Render a finished try-on in the representation the client asked for
+    """
+    mime_type = detect_mime_type(result_image_bytes)
+    representation = negotiate_tryon_media_type(http_request.headers.get("accept"), mime_type)
+    
+    if representation == "json":
+        return TryOnResponse(
+            id=tryon_id,
+            result_image=await encode_base64_image(result_image_bytes),
+            timestamp=timestamp,
+            status="completed",
+            cached=cached
+        )
+    
+    headers = {"Vary": "Accept"}
+    if representation == "image":
+        headers.update({
+            "X-Tryon-Id": tryon_id,
+            "X-Tryon-Timestamp": timestamp.isoformat(),
+            "X-Tryon-Status": "completed",
+            "X-Tryon-Cached": "true" if cached else "false",
+            "Content-Location": f"/api/tryon/{tryon_id}/image"
+        })
+        return Response(content=result_image_bytes, media_type=mime_type, headers=headers)
+    
+    metadata = json.dumps({
+        "id": tryon_id,
+        "timestamp": timestamp.isoformat(),
+        "status": "completed",
+        "cached": cached
+    }).encode()
+    extension = mime_type.split("/")[1]
+    boundary = secrets.token_hex(16)
+    body = b"".join([
+        f"--{boundary}\r\n".encode(),
+        b'Content-Type: application/json\r\nContent-Disposition: inline; name="metadata"\r\n\r\n',
+        metadata,
+        f"\r\n--{boundary}\r\n".encode(),
+        f'Content-Type: {mime_type}\r\nContent-Disposition: inline; name="result_image"; filename="{tryon_id}.{extension}"\r\n\r\n'.encode(),
+        result_image_bytes,
+        f"\r\n--{boundary}--\r\n".encode()
+    ])
+    return Response(content=body, media_type=f"multipart/mixed; boundary={boundary}", headers=headers)
+
+
+async def run_tryon(person_image: tuple, clothing_images: List[tuple], bypass_cache: bool = False):
+    """
+    Generate, store and announce a try-on for already ingested (image_bytes, metadata) pairs.
+    Returns (tryon_id, timestamp, result_image_bytes, cached); encoding is left to build_tryon_response.
+    """
+    tryon_id = str(uuid.uuid4())
+    
+    result_image_bytes, cached = await generate_tryon_result(
+        person_image,
+        clothing_images,
+        bypass_cache=bypass_cache
+    )
+    
+    # Save images to the blob store (identical images are stored once)
+    with tryon_stage("blob_store"):
+        person_image_ref, result_image_ref, *clothing_image_refs = await asyncio.gather(
+            blob_store.put(person_image[0]),
+            blob_store.put(result_image_bytes),
+            *[blob_store.put(clothing_image_bytes) for clothing_image_bytes, _ in clothing_images]
+        )
+    
+    # Save to database
+    tryon_record = {
+        "id": tryon_id,
+        "person_image_ref": person_image_ref,
+        "clothing_image_ref": clothing_image_refs[0],
+        "result_image_ref": result_image_ref,
+        "timestamp": datetime.utcnow(),
+        "status": "completed"
+    }
+    if len(clothing_image_refs) > 1:
+        # Outfits keep every garment; clothing_image_ref stays the first one for existing readers
+        tryon_record["clothing_image_refs"] = clothing_image_refs
+    
+    with tryon_stage("db_insert"):
+        await db.tryons.insert_one(tryon_record)
+    logger.info(f"Saved try-on record to database with id: {tryon_id}")
+    
+    # Queue data for the n8n webhook (delivered in the background with retries)
+    with tryon_stage("webhook_enqueue"):
+        await enqueue_tryon_webhook(tryon_id)
+    
+    return tryon_id, tryon_record["timestamp"], result_image_bytes, cached
+
+
+@api_router.post("/tryon", response_model=TryOnResponse, responses={200: {"content": TRYON_RESPONSE_CONTENT}})
+async def create_tryon(request: TryOnRequest, http_request: Request):
+    """
+    Virtual try-on endpoint that uses Gemini Nano Banana to generate
+    an image of the person wearing the clothing from the second image.
+    
+    Supports two modes:
+    1. Direct images: Pass person_image and clothing_image as base64
+    2. Upload IDs: Pass person_upload_id and clothing_upload_id from previous uploads
+    
+    For a full outfit, pass clothing_images or clothing_upload_ids instead (innermost layer first);
+    all garments are applied in a single generation.
+    
+    The response is JSON by default; send Accept: image/* or multipart/mixed to receive the raw result image.
     """
     try:
-        logger.info("Uploading person image...")
-        
-        upload_id = str(uuid.uuid4())
-        
-        # Store the uploaded image in MongoDB
-        upload_record = {
-            "upload_id": upload_id,
-            "image_type": "person",
-            "image_data": request.image,
-            "timestamp": datetime.utcnow(),
-            "status": "uploaded"
-        }
+        logger.info("Starting virtual try-on process...")
         
-        await db.uploads.insert_one(upload_record)
-        logger.info(f"Person image uploaded with ID: {upload_id}")
+        # Determine if using direct images or upload IDs
+        person_image, clothing_images = await resolve_tryon_images(request)
         
-        return ImageUploadResponse(
-            upload_id=upload_id,
-            timestamp=upload_record["timestamp"],
-            status="uploaded"
+        tryon_id, timestamp, result_image_bytes, cached = await run_tryon(
+            person_image, clothing_images, bypass_cache=request.bypass_cache
         )
+        return await build_tryon_response(http_request, tryon_id, timestamp, result_image_bytes, cached)
         
+    except HTTPException as he:
+        logger.error(f"HTTP Exception: {str(he)}")
+        raise he
     except Exception as e:
-        logger.error(f"Error uploading person image: {str(e)}", exc_info=True)
+        logger.error(f"Error in try-on process: {str(e)}", exc_info=True)
         raise HTTPException(
             status_code=500,
-            detail=f"Failed to upload person image: {str(e)}"
+            detail=f"Failed to process try-on request: {str(e)}"
         )
 
 
-@api_router.post("/upload/clothing", response_model=ImageUploadResponse)
-async def upload_clothing_image(request: ImageUploadRequest):
+@api_router.post("/tryon/binary", response_model=TryOnResponse, responses={200: {"content": TRYON_RESPONSE_CONTENT}})
+async def create_tryon_binary(
+    http_request: Request,
+    person_image: Optional[UploadFile] = File(None),
+    clothing_image: List[UploadFile] = File(None),
+    person_upload_id: Optional[str] = Form(None),
+    clothing_upload_id: List[str] = Form(None),
+    bypass_cache: bool = Form(False)
+):
     """
-    Upload clothing image and get an upload ID for later use
+    Virtual try-on with multipart/form-data input.
+    Send person_image and clothing_image as raw image files, or person_upload_id and clothing_upload_id as form fields.
+    Repeat clothing_image or clothing_upload_id to try on an outfit in one generation (innermost layer first).
+    The response is negotiated like /tryon (JSON, image/* or multipart/mixed).
     """
     try:
-        logger.info("Uploading clothing image...")
-        
-        upload_id = str(uuid.uuid4())
-        
-        # Store the uploaded image in MongoDB
-        upload_record = {
-            "upload_id": upload_id,
-            "image_type": "clothing",
-            "image_data": request.image,
-            "timestamp": datetime.utcnow(),
-            "status": "uploaded"
-        }
+        logger.info("Starting virtual try-on process (binary)...")
         
-        await db.uploads.insert_one(upload_record)
-        logger.info(f"Clothing image uploaded with ID: {upload_id}")
+        if person_image is not None and clothing_image:
+            logger.info("Using binary images mode")
+            check_garment_count(len(clothing_image))
+            person_image_bytes = await read_upload_file(person_image)
+            clothing_image_bytes = [await read_upload_file(upload) for upload in clothing_image]
+            person_image, *clothing_images = await asyncio.gather(
+                ingest_image_bytes(person_image_bytes),
+                *[ingest_image_bytes(image_bytes) for image_bytes in clothing_image_bytes]
+            )
+        else:
+            person_image, clothing_images = await resolve_tryon_images(
+                TryOnRequest(person_upload_id=person_upload_id, clothing_upload_ids=clothing_upload_id)
+            )
         
-        return ImageUploadResponse(
-            upload_id=upload_id,
-            timestamp=upload_record["timestamp"],
-            status="uploaded"
+        tryon_id, timestamp, result_image_bytes, cached = await run_tryon(
+            person_image, clothing_images, bypass_cache=bypass_cache
         )
+        return await build_tryon_response(http_request, tryon_id, timestamp, result_image_bytes, cached)
         
+    except HTTPException as he:
+        logger.error(f"HTTP Exception: {str(he)}")
+        raise he
     except Exception as e:
-        logger.error(f"Error uploading clothing image: {str(e)}", exc_info=True)
+        logger.error(f"Error in try-on process: {str(e)}", exc_info=True)
         raise HTTPException(
             status_code=500,
-            detail=f"Failed to upload clothing image: {str(e)}"
+            detail=f"Failed to process try-on request: {str(e)}"
         )
 
 
-@api_router.post("/tryon", response_model=TryOnResponse)
-async def create_tryon(request: TryOnRequest):
+async def run_tryon_batch_item(index: int, clothing_upload: dict, person_image: tuple, semaphore: asyncio.Semaphore, bypass_cache: bool) -> dict:
     """
-    Virtual try-on endpoint that uses Gemini Nano Banana to generate
-    an image of the person wearing the clothing from the second image.
+    Generate one garment of a batch. Failures are reported in the item instead of aborting the batch.
+    """
+    clothing_upload_id = clothing_upload["upload_id"]
+    async with semaphore:
+        try:
+            clothing_image = await load_upload_image(clothing_upload, clothing_upload_id)
+            tryon_id, timestamp, result_image_bytes, cached = await run_tryon(
+                person_image, [clothing_image], bypass_cache=bypass_cache
+            )
+        except HTTPException as he:
+            return {"index": index, "clothing_upload_id": clothing_upload_id, "status": "failed", "error": str(he.detail)}
+        except Exception as e:
+            logger.error(f"Error in batch try-on for clothing {clothing_upload_id}: {str(e)}", exc_info=True)
+            return {
+                "index": index,
+                "clothing_upload_id": clothing_upload_id,
+                "status": "failed",
+                "error": f"Failed to process try-on request: {str(e)}"
+            }
     
-    Supports two modes:
-    1. Direct images: Pass person_image and clothing_image as base64
-    2. Upload IDs: Pass person_upload_id and clothing_upload_id from previous uploads
+    return {
+        "index": index,
+        "clothing_upload_id": clothing_upload_id,
+        "id": tryon_id,
+        "status": "completed",
+        "result_image": await encode_base64_image(result_image_bytes),
+        "timestamp": timestamp.isoformat(),
+        "cached": cached
+    }
+
+
+@api_router.post("/tryon/batch")
+async def create_tryon_batch(request: TryOnBatchRequest):
+    """
+    Try one person on many garments in a single request.
+    Generations run concurrently (TRYON_BATCH_CONCURRENCY at a time) and each result is streamed back
+    as one NDJSON line as soon as it finishes, in completion order; "index" refers to clothing_upload_ids.
+    The person image is loaded once for the whole batch.
     """
     try:
-        logger.info("Starting virtual try-on process...")
+        if not request.clothing_upload_ids:
+            raise HTTPException(status_code=400, detail="clothing_upload_ids must not be empty")
+        if len(request.clothing_upload_ids) > TRYON_BATCH_MAX_ITEMS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"A batch can contain at most {TRYON_BATCH_MAX_ITEMS} garments"
+            )
         
-        # Get Gemini API key from environment
-        gemini_api_key = os.environ.get('GEMINI_API_KEY')
-        if not gemini_api_key:
-            logger.error("GEMINI_API_KEY not found in environment")
-            raise HTTPException(status_code=500, detail="Gemini API key not configured")
+        person_upload = await db.uploads.find_one(
+            {"upload_id": request.person_upload_id},
+            {"image_ref": 1, "image_data": 1, "image_meta": 1, "_id": 0}
+        )
+        if not person_upload:
+            raise HTTPException(status_code=404, detail=f"Person upload ID not found: {request.person_upload_id}")
         
-        tryon_id = str(uuid.uuid4())
+        # Resolve every garment up front so unknown IDs fail the request before streaming starts
+        clothing_uploads = await db.uploads.find(
+            {"upload_id": {"$in": request.clothing_upload_ids}},
+            {"upload_id": 1, "image_ref": 1, "image_data": 1, "image_meta": 1, "_id": 0}
+        ).to_list(None)
+        clothing_by_id = {upload["upload_id"]: upload for upload in clothing_uploads}
+        missing = [upload_id for upload_id in request.clothing_upload_ids if upload_id not in clothing_by_id]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Clothing upload ID not found: {', '.join(missing)}")
         
-        # Determine if using direct images or upload IDs
-        person_image_base64 = None
-        clothing_image_base64 = None
+        person_image = await load_upload_image(person_upload, request.person_upload_id)
+        await touch_uploads([request.person_upload_id, *clothing_by_id])
         
-        if request.person_upload_id and request.clothing_upload_id:
-            # Mode 1: Using upload IDs
-            logger.info("Using upload IDs mode")
-            
-            # Fetch person image from uploads collection - Explicitly project image_data
-            person_upload = await db.uploads.find_one(
-                {"upload_id": request.person_upload_id},
-                {"image_data": 1, "_id": 0}
-            )
-            if not person_upload:
-                raise HTTPException(status_code=404, detail=f"Person upload ID not found: {request.person_upload_id}")
-            
-            # Fetch clothing image from uploads collection - Explicitly project image_data
-            clothing_upload = await db.uploads.find_one(
-                {"upload_id": request.clothing_upload_id},
-                {"image_data": 1, "_id": 0}
-            )
-            if not clothing_upload:
-                raise HTTPException(status_code=404, detail=f"Clothing upload ID not found: {request.clothing_upload_id}")
-            
-            person_image_base64 = person_upload["image_data"]
-            clothing_image_base64 = clothing_upload["image_data"]
-            
-            logger.info(f"Retrieved images from uploads: person={request.person_upload_id}, clothing={request.clothing_upload_id}")
-            
-        elif request.person_image and request.clothing_image:
-            # Mode 2: Direct images (backward compatibility)
-            logger.info("Using direct images mode")
-            person_image_base64 = request.person_image
-            clothing_image_base64 = request.clothing_image
-            
-        else:
-            raise HTTPException(
-                status_code=400,
-                detail="Must provide either (person_image + clothing_image) OR (person_upload_id + clothing_upload_id)"
-            )
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error preparing batch try-on: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Failed to process try-on request: {str(e)}")
+    
+    logger.info(f"Starting batch try-on of {len(request.clothing_upload_ids)} garments for person {request.person_upload_id}")
+    
+    async def stream_results():
+        semaphore = asyncio.Semaphore(TRYON_BATCH_CONCURRENCY)
+        tasks = [
+            asyncio.create_task(run_tryon_batch_item(
+                index, clothing_by_id[clothing_upload_id], person_image, semaphore, request.bypass_cache
+            ))
+            for index, clothing_upload_id in enumerate(request.clothing_upload_ids)
+        ]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield json.dumps(await finished) + "\n"
+        finally:
+            # The client went away mid-batch, stop generating what nobody will receive
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+@api_router.post("/tryon/jobs", response_model=TryOnJobResponse, status_code=202)
+async def submit_tryon_job(request: TryOnRequest):
+    """
+    Queue a virtual try-on and return a job ID immediately.
+    Accepts the same body as /api/tryon; poll /api/tryon/jobs/{job_id} for the result.
+    """
+    try:
+        (person_image_bytes, person_meta), clothing_images = await resolve_tryon_images(request)
+        person_image_ref, *clothing_image_refs = await asyncio.gather(
+            blob_store.put(person_image_bytes),
+            *[blob_store.put(clothing_image_bytes) for clothing_image_bytes, _ in clothing_images]
+        )
         
-        # Create Gemini client
-        client = genai.Client(api_key=gemini_api_key)
-        
-        logger.info("Preparing images for Gemini...")
-        
-        # Decode base64 to create Part objects with inline data
-        person_image_bytes = base64.b64decode(person_image_base64)
-        clothing_image_bytes = base64.b64decode(clothing_image_base64)
-        
-        # Detect actual mime type from image bytes
-        def detect_mime_type(image_bytes):
-            # Check magic bytes to determine image type
-            if image_bytes.startswith(b'\xff\xd8\xff'):
-                return "image/jpeg"
-            elif image_bytes.startswith(b'\x89PNG'):
-                return "image/png"
-            elif image_bytes.startswith(b'RIFF') and image_bytes[8:12] == b'WEBP':
-                return "image/webp"
-            elif image_bytes.startswith(b'GIF87a') or image_bytes.startswith(b'GIF89a'):
-                return "image/gif"
-            else:
-                # Default to jpeg if unknown
-                return "image/jpeg"
+        job_id = str(uuid.uuid4())
         
-        person_mime = detect_mime_type(person_image_bytes)
-        clothing_mime = detect_mime_type(clothing_image_bytes)
+        # The job lives in the tryons collection so a completed job is an ordinary try-on record
+        job_record = {
+            "id": job_id,
+            "person_image_ref": person_image_ref,
+            "clothing_image_ref": clothing_image_refs[0],
+            "person_image_meta": person_meta,
+            "clothing_image_metas": [clothing_meta for _, clothing_meta in clothing_images],
+            "bypass_cache": request.bypass_cache,
+            "timestamp": datetime.utcnow(),
+            "status": "queued",
+            "mode": "job"
+        }
+        if len(clothing_image_refs) > 1:
+            job_record["clothing_image_refs"] = clothing_image_refs
+        
+        await db.tryons.insert_one(job_record)
+        tryon_job_queue.put_nowait(job_id)
+        logger.info(f"Queued try-on job {job_id} (queue depth: {tryon_job_queue.qsize()})")
+        
+        return TryOnJobResponse(
+            job_id=job_id,
+            status="queued",
+            timestamp=job_record["timestamp"]
+        )
+        
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error queueing try-on job: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to queue try-on request: {str(e)}"
+        )
+
+
+@api_router.get("/tryon/jobs/{job_id}", response_model=TryOnJobResponse)
+async def get_tryon_job(job_id: str):
+    """
+    Get the status of a queued try-on, including the result image once completed
+    """
+    try:
+        job = await db.tryons.find_one(
+            {"id": job_id},
+            {"_id": 0, "id": 1, "status": 1, "timestamp": 1, "result_image_ref": 1, "error": 1, "cached": 1}
+        )
+        if not job:
+            raise HTTPException(status_code=404, detail="Try-on job not found")
+        
+        result_image_base64 = None
+        if job.get("result_image_ref"):
+            result_image_bytes = await blob_store.get(job["result_image_ref"])
+            result_image_base64 = await encode_base64_image(result_image_bytes)
         
-        # Calculate aspect ratio from person image
+        return TryOnJobResponse(
+            job_id=job["id"],
+            status=job["status"],
+            timestamp=job["timestamp"],
+            result_image=result_image_base64,
+            error=job.get("error"),
+            cached=job.get("cached", False)
+        )
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error fetching try-on job: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def load_job_image(image_ref: str, image_meta: Optional[dict]) -> tuple:
+    """
+    Load a queued job's input image; jobs queued before ingestion metadata existed are described once here
+    """
+    image_bytes = await blob_store.get(image_ref)
+    if not image_meta:
+        _, image_meta = await ingest_image_bytes(image_bytes, normalize=False)
+    return image_bytes, image_meta
+
+
+async def run_tryon_job(job_id: str):
+    """
+    Run a single queued try-on job and record its outcome on the try-on record
+    """
+    # Claim the job atomically so it can never run twice
+    job = await db.tryons.find_one_and_update(
+        {"id": job_id, "status": "queued"},
+        {"$set": {"status": "running", "started_at": datetime.utcnow()}},
+        projection={
+            "_id": 0,
+            "person_image_ref": 1,
+            "clothing_image_ref": 1,
+            "clothing_image_refs": 1,
+            "person_image_meta": 1,
+            "clothing_image_metas": 1,
+            "bypass_cache": 1
+        }
+    )
+    if not job:
+        logger.warning(f"Try-on job {job_id} is no longer queued, skipping")
+        return
+    
+    try:
+        clothing_image_refs = job.get("clothing_image_refs") or [job["clothing_image_ref"]]
+        clothing_metas = job.get("clothing_image_metas") or [None] * len(clothing_image_refs)
+        person_image, *clothing_images = await asyncio.gather(
+            load_job_image(job["person_image_ref"], job.get("person_image_meta")),
+            *[load_job_image(ref, meta) for ref, meta in zip(clothing_image_refs, clothing_metas)]
+        )
+        result_image_bytes, cached = await generate_tryon_result(
+            person_image,
+            clothing_images,
+            bypass_cache=job.get("bypass_cache", False),
+            bounded=False
+        )
+        result_image_ref = await blob_store.put(result_image_bytes)
+    except HTTPException as he:
+        error = str(he.detail)
+    except Exception as e:
+        logger.error(f"Error in try-on job {job_id}: {str(e)}", exc_info=True)
+        error = f"Failed to process try-on request: {str(e)}"
+    else:
+        await db.tryons.update_one(
+            {"id": job_id},
+            {"$set": {
+                "result_image_ref": result_image_ref,
+                "cached": cached,
+                "status": "completed",
+                "completed_at": datetime.utcnow()
+            }}
+        )
+        logger.info(f"Try-on job {job_id} completed")
+        await enqueue_tryon_webhook(job_id)
+        return
+    
+    await db.tryons.update_one(
+        {"id": job_id},
+        {"$set": {"status": "failed", "error": error, "completed_at": datetime.utcnow()}}
+    )
+    logger.error(f"Try-on job {job_id} failed: {error}")
+
+
+async def tryon_job_worker(worker_index: int):
+    """
+    Background worker pulling job IDs off the in-process queue
+    """
+    while True:
+        job_id = await tryon_job_queue.get()
         try:
-            with Image.open(io.BytesIO(person_image_bytes)) as img:
-                width, height = img.size
-                ratio = width / height
-                
-                # Determine closest supported aspect ratio for Gemini
-                # Supported: "1:1", "3:4", "4:3", "9:16", "16:9"
-                supported_ratios = {
-                    "1:1": 1.0,
-                    "3:4": 0.75,
-                    "4:3": 1.33,
-                    "9:16": 0.5625,
-                    "16:9": 1.77
-                }
-                
-                closest_ratio = min(supported_ratios.items(), key=lambda x: abs(x[1] - ratio))
-                target_aspect_ratio = closest_ratio[0]
-                logger.info(f"Input dimensions: {width}x{height} (Ratio: {ratio:.2f}). Target Gemini Ratio: {target_aspect_ratio}")
+            await run_tryon_job(job_id)
         except Exception as e:
-            logger.warning(f"Failed to calculate aspect ratio: {e}")
-            target_aspect_ratio = "1:1" # Default fallback
+            logger.error(f"Try-on worker {worker_index} failed on job {job_id}: {str(e)}", exc_info=True)
+        finally:
+            tryon_job_queue.task_done()
+
+
+@api_router.get("/tryon/cache/stats")
+async def get_tryon_cache_stats():
+    """
+    Get hit/miss counters and current size of the try-on result cache
+    """
+    lookups = tryon_cache_stats["hits"] + tryon_cache_stats["misses"]
+    return {
+        **tryon_cache_stats,
+        "hit_rate": round(tryon_cache_stats["hits"] / lookups, 4) if lookups else 0.0,
+        "entries": len(tryon_result_cache),
+        "size_bytes": tryon_result_cache.currsize,
+        "max_bytes": tryon_result_cache.maxsize,
+        "ttl_seconds": TRYON_CACHE_TTL_SECONDS,
+        "in_flight": len(tryon_generations_in_flight)
+    }
+
+
+@api_router.get("/images/{image_ref}")
+async def get_signed_image(image_ref: str, expires: int, signature: str):
+    """
+    Serve raw image bytes for a signed, expiring URL (used by reference-mode webhook payloads)
+    """
+    try:
+        remaining = expires - int(time.time())
+        if remaining <= 0:
+            raise HTTPException(status_code=403, detail="Image URL has expired")
+        if not hmac.compare_digest(signature, sign_image_ref(image_ref, expires)):
+            raise HTTPException(status_code=403, detail="Invalid image URL signature")
         
-        logger.info(f"Person image mime type: {person_mime}")
-        logger.info(f"Clothing image mime type: {clothing_mime}")
+        try:
+            image_bytes = await blob_store.get(image_ref)
+        except KeyError:
+            raise HTTPException(status_code=404, detail="Image not found")
         
-        # Create Part objects for images with correct mime types
-        person_part = types.Part.from_bytes(
-            data=person_image_bytes,
-            mime_type=person_mime
+        return Response(
+            content=image_bytes,
+            media_type=detect_mime_type(image_bytes),
+            headers={"Cache-Control": f"private, max-age={remaining}"}
+        )
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error serving image: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@api_router.get("/webhooks/outbox/stats")
+async def get_webhook_outbox_stats():
+    """
+    Get n8n webhook delivery counters and the number of outbox entries per state
+    """
+    try:
+        status_counts = await db.webhook_outbox.aggregate([
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+        ]).to_list(None)
+        oldest_pending = await db.webhook_outbox.find_one(
+            {"status": {"$in": ["pending", "sending"]}},
+            {"_id": 0, "created_at": 1},
+            sort=[("created_at", 1)]
         )
-        
-        clothing_part = types.Part.from_bytes(
-            data=clothing_image_bytes,
-            mime_type=clothing_mime
+        return {
+            **webhook_stats,
+            "outbox": {entry["_id"]: entry["count"] for entry in status_counts},
+            "oldest_pending_at": oldest_pending["created_at"] if oldest_pending else None
+        }
+    except Exception as e:
+        logger.error(f"Error fetching webhook outbox stats: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@api_router.post("/webhooks/outbox/{delivery_id}/retry")
+async def retry_webhook_delivery(delivery_id: str):
+    """
+    Move a dead-lettered webhook delivery back to pending
+    """
+    try:
+        now = datetime.utcnow()
+        result = await db.webhook_outbox.update_one(
+            {"id": delivery_id, "status": "dead"},
+            {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": now, "updated_at": now}}
         )
-        
-        # Original text prompt (kept for reference)
-        # text_prompt = """Your task is to perform a virtual try-on. The first image contains a person. The second image contains one or more clothing items. Identify the garments (e.g., shirt, pants, jacket) in the second image, ignoring any person or mannequin wearing them. Then, generate a new, photorealistic image where the person from the first image is wearing those garments. The person's original pose, face, and the background should be maintained."""
-        
-        logger.info("Calling Gemini for virtual try-on...")
-        
-        # Enhanced prompt with strongest identity preservation + Headwear support
-        text_prompt = """**Primary Directive: High-Fidelity Virtual Try-On**
+        if result.matched_count == 0:
+            raise HTTPException(status_code=404, detail="Dead-lettered webhook delivery not found")
+        webhook_wakeup.set()
+        return {"success": True, "id": delivery_id, "status": "pending"}
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error retrying webhook delivery: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-You are an expert digital tailor. Your task is to execute a precise clothing/accessory swap.
 
-**!!! CORE SAFETY DIRECTIVE: PROTECT FACIAL IDENTITY !!!**
-**The person's facial features (eyes, nose, mouth, jawline, skin tone) in Image 1 are a STRICT NO-EDIT ZONE. They must be preserved perfectly to maintain identity. Any distortion to the face is a failure.**
+@api_router.get("/retention/stats")
+async def get_retention_stats():
+    """
+    Get retention settings and what the archival sweeps have reclaimed so far
+    """
+    return {
+        "upload_retention_hours": UPLOAD_RETENTION_HOURS,
+        "tryon_archive_after_days": TRYON_ARCHIVE_AFTER_DAYS,
+        "blob_gc_enabled": BLOB_GC_ENABLED,
+        "blob_gc_grace_seconds": BLOB_GC_GRACE_SECONDS,
+        **retention_stats
+    }
 
-**Input Definitions:**
-- **Image 1 (The Canvas):** Contains the person.
-- **Image 2 (The Source):** Contains the garment(s) or accessory.
 
-**--- CRITICAL RULES ---**
+@api_router.post("/retention/run")
+async def trigger_retention_sweep():
+    """
+    Run an archival sweep now and return its report
+    """
+    if retention_lock.locked():
+        raise HTTPException(status_code=409, detail="A retention sweep is already running")
+    try:
+        return await run_retention_sweep()
+    except Exception as e:
+        logger.error(f"Error running retention sweep: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
 
-1.  **PRESERVE THE CANVAS:** Keep the original pose, background, and **ASPECT RATIO** exactly as they are in Image 1. Do not crop, stretch, or resize the person.
-2.  **SMART MAPPING (Headwear Exception):** 
-    - generally, do NOT edit the head or hair.
-    - **HOWEVER**, if the source item is **HEADWEAR** (hat, cap, beanie, sunglasses, etc.), you **MUST** apply it to the person's head/face appropriately, modifying hair/head shape only as needed to fit the item realistically.
-3.  **EXTRACT FROM THE SOURCE:** Accurately transfer the color, pattern, and texture from Image 2.
-4.  **DISCARD ORIGINAL CLOTHING:** Ignore the old clothes in the target area.
 
-**--- STEP-BY-STEP EXECUTION ---**
+@api_router.get("/gemini/pool")
+async def get_gemini_pool_stats():
+    """
+    Get per-key concurrency and quota counters of the Gemini client pool
+    """
+    return {
+        "per_key_concurrency": GEMINI_PER_KEY_CONCURRENCY,
+        "admission": generation_admission.stats(),
+        "keys": gemini_pool.stats() if gemini_pool else []
+    }
 
-1.  **Analyze Source:** Is it a shirt? Pants? A Hat? A Dress?
-2.  **Map Target:** 
-    - If Shirt/Pants/Dress -> Map to body, exclude head/hands.
-    - If Hat/Glasses -> Map to head/face, preserving identity features underneath.
-3.  **Render:** Generate the photorealistic result within the exact bounds of Image 1.
 
-**!! FINAL MANDATE !!**
-Identity protected. Clothing/Accessory perfectly transferred. Photorealistic. No stretching or distortion."""
-        
-        optimized_text_part = types.Part(text=text_prompt)
-        
-        logger.info("Calling Gemini 2.5 Flash Image model...")
-        
-        # Minimal config - let model use defaults
-        config = types.GenerateContentConfig(
-            response_modalities=["IMAGE"],
-            image_config=types.ImageConfig(
-                aspect_ratio=target_aspect_ratio
-            )
-        )
-        
-        # Create a Content object with all parts
-        content = types.Content(
-            parts=[person_part, clothing_part, optimized_text_part]
-        )
-        
-        # Generate content
-        response = await asyncio.to_thread(
-            client.models.generate_content,
-            model="gemini-3-pro-image-preview",
-            contents=content,
-            config=config
-        )
-        
-        logger.info("Received response from Gemini")
-        logger.info(f"Response parts: {len(response.parts) if response.parts else 0}")
-        
-        # Find the image part in the response
-        result_image_base64 = None
-        
-        for part in response.parts:
-            if part.inline_data is not None:
-                # The data comes as bytes, need to encode to base64
-                image_data = part.inline_data.data
-                if isinstance(image_data, bytes):
-                    result_image_base64 = base64.b64encode(image_data).decode('utf-8')
-                else:
-                    result_image_base64 = image_data
-                logger.info(f"Found generated image in response. Size: {len(result_image_base64)} characters")
-                break
-        
-        if not result_image_base64:
-            logger.error("No image found in Gemini response")
-            logger.error(f"Response: {response}")
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to generate try-on image. No image was returned in the response."
-            )
-        
-        # Save to database
-        tryon_record = {
-            "id": tryon_id,
-            "person_image": person_image_base64,
-            "clothing_image": clothing_image_base64,
-            "result_image": result_image_base64,
-            "timestamp": datetime.utcnow(),
-            "status": "completed"
-        }
-        
-        await db.tryons.insert_one(tryon_record)
-        logger.info(f"Saved try-on record to database with id: {tryon_id}")
-        
-        # Send data to n8n webhook (non-blocking, fails silently)
-        asyncio.create_task(
-            send_to_n8n_webhook(
-                person_image_base64=person_image_base64,
-                clothing_image_base64=clothing_image_base64,
-                result_image_base64=result_image_base64,
-                tryon_id=tryon_id
-            )
+@api_router.get("/tryon/{tryon_id}/image")
+async def get_tryon_image(tryon_id: str, http_request: Request, variant: str = "full"):
+    """
+    Get a try-on result as a binary image (variant: thumbnail, medium or full)
+    """
+    try:
+        tryon = await db.tryons.find_one(
+            {"id": tryon_id},
+            {"_id": 0, "result_image_ref": 1, "result_image": 1}
         )
+        if not tryon:
+            raise HTTPException(status_code=404, detail="Try-on not found")
+        if not tryon.get("result_image_ref") and not tryon.get("result_image"):
+            raise HTTPException(status_code=404, detail="Try-on result is not available yet")
         
-        return TryOnResponse(
-            id=tryon_id,
-            result_image=result_image_base64,
-            timestamp=tryon_record["timestamp"],
-            status="completed"
+        return await serve_image_variant(http_request, tryon, "result_image_ref", "result_image", variant)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error serving try-on image: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@api_router.get("/upload/{upload_id}/image")
+async def get_upload_image(upload_id: str, http_request: Request, variant: str = "full"):
+    """
+    Get an uploaded person or clothing image as a binary image (variant: thumbnail, medium or full)
+    """
+    try:
+        upload = await db.uploads.find_one(
+            {"upload_id": upload_id},
+            {"_id": 0, "image_ref": 1, "image_data": 1}
         )
+        if not upload:
+            raise HTTPException(status_code=404, detail="Upload not found")
         
+        return await serve_image_variant(http_request, upload, "image_ref", "image_data", variant)
     except HTTPException as he:
-        logger.error(f"HTTP Exception: {str(he)}")
         raise he
     except Exception as e:
-        logger.error(f"Error in try-on process: {str(e)}", exc_info=True)
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to process try-on request: {str(e)}"
-        )
+        logger.error(f"Error serving upload image: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 @api_router.get("/tryon/{tryon_id}")
@@ -465,13 +3040,21 @@ async def get_tryon(tryon_id: str):
     Get a specific try-on result by ID
     """
     try:
-        tryon = await db.tryons.find_one({"id": tryon_id})
+        tryon = await db.tryons.find_one(
+            {"id": tryon_id},
+            {"_id": 0, "id": 1, "status": 1, "timestamp": 1, "result_image_ref": 1, "result_image": 1}
+        )
         if not tryon:
             raise HTTPException(status_code=404, detail="Try-on not found")
         
+        result_image_base64 = ""
+        if tryon.get("result_image_ref") or tryon.get("result_image"):
+            result_image_bytes = await load_image_bytes(tryon, "result_image_ref", "result_image")
+            result_image_base64 = await encode_base64_image(result_image_bytes)
+        
         return TryOnResponse(
             id=tryon["id"],
-            result_image=tryon["result_image"],
+            result_image=result_image_base64,
             timestamp=tryon["timestamp"],
             status=tryon["status"]
         )
@@ -482,6 +3065,120 @@ async def get_tryon(tryon_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Feedback serial numbers come from a single counter document, incremented atomically
+FEEDBACK_SERIAL_COUNTER_ID = "feedback_serial"
+
+
+async def next_feedback_serial() -> int:
+    counter = await db.counters.find_one_and_update(
+        {"_id": FEEDBACK_SERIAL_COUNTER_ID},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
+
+async def backfill_feedback_serial_counter():
+    """
+    Seed the counter from existing feedback the first time it is needed,
+    so serial numbers continue where the count-based numbering stopped
+    """
+    if await db.counters.find_one({"_id": FEEDBACK_SERIAL_COUNTER_ID}, {"_id": 1}):
+        return
+    
+    latest = await db.tryons.find_one(
+        {"feedback": {"$exists": True}, "feedback.serial_number": {"$exists": True}},
+        {"_id": 0, "feedback.serial_number": 1},
+        sort=[("feedback.serial_number", -1)]
+    )
+    highest_serial = latest["feedback"]["serial_number"] if latest else 0
+    feedback_count = await db.tryons.count_documents({"feedback": {"$exists": True}})
+    
+    # $max keeps this safe if another instance seeded or incremented the counter meanwhile
+    await db.counters.update_one(
+        {"_id": FEEDBACK_SERIAL_COUNTER_ID},
+        {"$max": {"seq": max(highest_serial, feedback_count)}},
+        upsert=True
+    )
+    logger.info(f"Seeded feedback serial counter at {max(highest_serial, feedback_count)}")
+
+
+# Feedback rollups: one db.feedback_daily document per UTC day, updated on every submission
+FEEDBACK_ROLLUP_MARKER_ID = "feedback_daily_rollup"
+
+
+async def update_feedback_rollup(feedback_date: Optional[str], rating: Optional[int], delta: int):
+    if not feedback_date or rating is None:
+        return
+    await db.feedback_daily.update_one(
+        {"_id": feedback_date},
+        {
+            "$inc": {
+                "count": delta,
+                "rating_sum": delta * rating,
+                f"ratings.{rating}": delta
+            },
+            "$set": {"updated_at": datetime.utcnow()}
+        },
+        upsert=True
+    )
+
+
+async def backfill_feedback_rollups():
+    """
+    Build the daily rollups from existing feedback once, before incremental updates take over
+    """
+    if await db.counters.find_one({"_id": FEEDBACK_ROLLUP_MARKER_ID}, {"_id": 1}):
+        return
+    
+    groups = await db.tryons.aggregate([
+        {"$match": {"feedback": {"$exists": True}}},
+        {"$group": {
+            "_id": {"date": "$feedback.feedback_date", "rating": "$feedback.rating"},
+            "count": {"$sum": 1}
+        }}
+    ]).to_list(None)
+    
+    days = {}
+    for group in groups:
+        date, rating = group["_id"].get("date"), group["_id"].get("rating")
+        if not date or rating is None:
+            continue
+        day = days.setdefault(date, {"count": 0, "rating_sum": 0, "ratings": {}})
+        day["count"] += group["count"]
+        day["rating_sum"] += rating * group["count"]
+        day["ratings"][str(rating)] = day["ratings"].get(str(rating), 0) + group["count"]
+    
+    for date, day in days.items():
+        await db.feedback_daily.update_one(
+            {"_id": date},
+            {"$set": {**day, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+    
+    await db.counters.update_one(
+        {"_id": FEEDBACK_ROLLUP_MARKER_ID},
+        {"$set": {"backfilled_at": datetime.utcnow(), "days": len(days)}},
+        upsert=True
+    )
+    logger.info(f"Backfilled feedback rollups for {len(days)} days")
+
+
+def summarize_feedback_days(days: List[dict]) -> dict:
+    total = sum(day.get("count", 0) for day in days)
+    rating_sum = sum(day.get("rating_sum", 0) for day in days)
+    distribution = {str(star): 0 for star in range(1, 6)}
+    for day in days:
+        for star, count in day.get("ratings", {}).items():
+            distribution[star] = distribution.get(star, 0) + count
+    return {
+        "total": total,
+        "average_rating": round(rating_sum / total, 2) if total else None,
+        "rating_distribution": distribution
+    }
+
+
 @api_router.post("/feedback")
 async def submit_feedback(feedback: FeedbackRequest):
     """
@@ -489,31 +3186,46 @@ async def submit_feedback(feedback: FeedbackRequest):
     """
     try:
         # Verify try-on exists - optimized to fetch only ID
-        tryon = await db.tryons.find_one({"id": feedback.tryon_id}, {"_id": 1})
+        with trace_span("tryon_lookup"):
+            tryon = await db.tryons.find_one({"id": feedback.tryon_id}, {"_id": 1})
         if not tryon:
             raise HTTPException(status_code=404, detail="Try-on not found")
         
-        # Get the next serial number for feedback
-        # Count all existing feedback to generate serial number
-        feedback_count = await db.tryons.count_documents({"feedback": {"$exists": True}})
-        serial_number = feedback_count + 1
+        # Get the next serial number for feedback from the atomic counter
+        with trace_span("serial_allocation"):
+            serial_number = await next_feedback_serial()
         
-        # Update try-on with feedback
-        await db.tryons.update_one(
-            {"id": feedback.tryon_id},
-            {
-                "$set": {
-                    "feedback": {
-                        "serial_number": serial_number,
-                        "rating": feedback.rating,
-                        "comment": feedback.comment,
-                        "customer_name": feedback.customer_name,
-                        "feedback_timestamp": datetime.utcnow(),
-                        "feedback_date": datetime.utcnow().strftime("%Y-%m-%d")  # For daily tracking
+        # Update try-on with feedback, atomically capturing any feedback it replaces
+        now = datetime.utcnow()
+        feedback_date = now.strftime("%Y-%m-%d")  # For daily tracking
+        with trace_span("feedback_update"):
+            previous = await db.tryons.find_one_and_update(
+                {"id": feedback.tryon_id},
+                {
+                    "$set": {
+                        "feedback": {
+                            "serial_number": serial_number,
+                            "rating": feedback.rating,
+                            "comment": feedback.comment,
+                            "customer_name": feedback.customer_name,
+                            "feedback_timestamp": now,
+                            "feedback_date": feedback_date
+                        }
                     }
-                }
-            }
-        )
+                },
+                projection={"feedback.rating": 1, "feedback.feedback_date": 1},
+                return_document=ReturnDocument.BEFORE
+            )
+        if previous is None:
+            # Deleted (or archived) since the lookup above, so there is no feedback to count
+            raise HTTPException(status_code=404, detail="Try-on not found")
+        
+        with trace_span("rollup_update"):
+            await update_feedback_rollup(feedback_date, feedback.rating, 1)
+            previous_feedback = previous.get("feedback")
+            if previous_feedback:
+                # Resubmitted feedback replaces the old rating in the rollups
+                await update_feedback_rollup(previous_feedback.get("feedback_date"), previous_feedback.get("rating"), -1)
         
         logger.info(f"Feedback #{serial_number} saved for try-on {feedback.tryon_id}: {feedback.rating} stars")
         
@@ -530,6 +3242,156 @@ async def submit_feedback(feedback: FeedbackRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Feedback Listing Configuration
+FEEDBACK_PAGE_SIZE = 25
+FEEDBACK_PAGE_MAX = 100
+
+
+def encode_feedback_cursor(feedback_timestamp: datetime, tryon_id: str) -> str:
+    raw = json.dumps({"ts": feedback_timestamp.isoformat(), "id": tryon_id})
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("utf-8").rstrip("=")
+
+
+def decode_feedback_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        return datetime.fromisoformat(data["ts"]), data["id"]
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def parse_feedback_date(value: str, name: str) -> datetime:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be formatted as YYYY-MM-DD")
+
+
+@api_router.get("/feedback")
+async def list_feedback(
+    limit: int = FEEDBACK_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    rating: Optional[int] = None,
+    min_rating: Optional[int] = None,
+    max_rating: Optional[int] = None
+):
+    """
+    List feedback newest first, one page at a time, without inline images.
+    Pass the returned next_cursor to fetch the following page.
+    """
+    try:
+        limit = max(1, min(limit, FEEDBACK_PAGE_MAX))
+        query = {"feedback": {"$exists": True}}
+        
+        # Date range on the feedback timestamp (end_date is inclusive)
+        timestamp_range = {}
+        if start_date:
+            timestamp_range["$gte"] = parse_feedback_date(start_date, "start_date")
+        if end_date:
+            timestamp_range["$lt"] = parse_feedback_date(end_date, "end_date") + timedelta(days=1)
+        if timestamp_range:
+            query["feedback.feedback_timestamp"] = timestamp_range
+        
+        rating_range = {}
+        if rating is not None:
+            rating_range["$eq"] = rating
+        if min_rating is not None:
+            rating_range["$gte"] = min_rating
+        if max_rating is not None:
+            rating_range["$lte"] = max_rating
+        if rating_range:
+            query["feedback.rating"] = rating_range
+        
+        # Continue strictly after the last row of the previous page
+        if cursor:
+            cursor_timestamp, cursor_id = decode_feedback_cursor(cursor)
+            query["$or"] = [
+                {"feedback.feedback_timestamp": {"$lt": cursor_timestamp}},
+                {"feedback.feedback_timestamp": cursor_timestamp, "id": {"$lt": cursor_id}}
+            ]
+        
+        tryons_with_feedback = await db.tryons.find(
+            query,
+            {"_id": 0, "id": 1, "timestamp": 1, "feedback": 1, "result_image_ref": 1}
+        ).sort([("feedback.feedback_timestamp", -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+        
+        has_more = len(tryons_with_feedback) > limit
+        tryons_with_feedback = tryons_with_feedback[:limit]
+        
+        feedback_list = []
+        for tryon in tryons_with_feedback:
+            feedback_data = tryon.get("feedback", {})
+            feedback_list.append({
+                "tryon_id": tryon.get("id"),
+                "serial_number": feedback_data.get("serial_number"),
+                "timestamp": tryon.get("timestamp"),
+                "rating": feedback_data.get("rating"),
+                "comment": feedback_data.get("comment"),
+                "customer_name": feedback_data.get("customer_name"),
+                "feedback_timestamp": feedback_data.get("feedback_timestamp"),
+                "feedback_date": feedback_data.get("feedback_date"),
+                "result_image_ref": tryon.get("result_image_ref"),
+                "thumbnail_url": f"{PUBLIC_BASE_URL}/api/tryon/{tryon.get('id')}/image?variant=thumbnail"
+            })
+        
+        next_cursor = None
+        if has_more:
+            last = tryons_with_feedback[-1]
+            next_cursor = encode_feedback_cursor(last["feedback"]["feedback_timestamp"], last["id"])
+        
+        return {
+            "feedback": feedback_list,
+            "count": len(feedback_list),
+            "has_more": has_more,
+            "next_cursor": next_cursor
+        }
+        
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error listing feedback: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@api_router.get("/feedback/analytics")
+async def get_feedback_analytics(start_date: Optional[str] = None, end_date: Optional[str] = None):
+    """
+    Exact feedback counts, rating histogram and average for any date range (inclusive, YYYY-MM-DD),
+    answered from the daily rollups
+    """
+    try:
+        date_range = {}
+        if start_date:
+            parse_feedback_date(start_date, "start_date")
+            date_range["$gte"] = start_date
+        if end_date:
+            parse_feedback_date(end_date, "end_date")
+            date_range["$lte"] = end_date
+        query = {"_id": date_range} if date_range else {}
+        
+        days = await db.feedback_daily.find(query).sort("_id", 1).to_list(None)
+        days = [day for day in days if day.get("count", 0) > 0]
+        
+        return {
+            "start_date": start_date,
+            "end_date": end_date,
+            **summarize_feedback_days(days),
+            "daily": [
+                {"date": day["_id"], **summarize_feedback_days([day])}
+                for day in days
+            ]
+        }
+        
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error computing feedback analytics: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @api_router.get("/feedback/all")
 async def get_all_feedback():
     """
@@ -538,13 +3400,19 @@ async def get_all_feedback():
     try:
         # Find all try-ons that have feedback - Limit to 50 for performance
         tryons_with_feedback = await db.tryons.find(
-            {"feedback": {"$exists": True}}
+            {"feedback": {"$exists": True}},
+            {"_id": 0, "id": 1, "timestamp": 1, "feedback": 1, "result_image_ref": 1, "result_image": 1}
         ).sort("feedback.feedback_timestamp", -1).limit(50).to_list(50)
         
+        # Load result images from the blob store concurrently
+        result_images = await asyncio.gather(*[
+            load_image_bytes(tryon, "result_image_ref", "result_image")
+            for tryon in tryons_with_feedback
+        ])
+        
         feedback_list = []
-        daily_counts = {}
         
-        for tryon in tryons_with_feedback:
+        for tryon, result_image_bytes in zip(tryons_with_feedback, result_images):
             feedback_data = tryon.get("feedback", {})
             feedback_item = {
                 "tryon_id": tryon.get("id"),
@@ -555,13 +3423,9 @@ async def get_all_feedback():
                 "customer_name": feedback_data.get("customer_name"),
                 "feedback_timestamp": feedback_data.get("feedback_timestamp"),
                 "feedback_date": feedback_data.get("feedback_date"),
-                "result_image": tryon.get("result_image")
+                "result_image": await encode_base64_image(result_image_bytes)
             }
             feedback_list.append(feedback_item)
-            
-            # Count feedback per day
-            date = feedback_data.get("feedback_date", "Unknown")
-            daily_counts[date] = daily_counts.get(date, 0) + 1
         
         # Sort by serial number (descending - most recent first)
         feedback_list.sort(
@@ -569,10 +3433,11 @@ async def get_all_feedback():
             reverse=True
         )
         
-        # Calculate daily statistics
+        # Daily statistics come from the rollups, so they cover all feedback, not just this page
+        days = await db.feedback_daily.find({"count": {"$gt": 0}}).sort("_id", -1).to_list(None)
         daily_stats = [
-            {"date": date, "count": count}
-            for date, count in sorted(daily_counts.items(), reverse=True)
+            {"date": day["_id"], "count": day["count"]}
+            for day in days
         ]
         
         return {
@@ -586,17 +3451,248 @@ async def get_all_feedback():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Index Configuration
+# Every query path in this file is backed by one of these indexes; they are created at startup.
+# Feedback queries always filter on {"feedback": {"$exists": True}} so they can use the partial indexes.
+REQUIRED_INDEXES = [
+    ("uploads", [("upload_id", 1)], {"name": "upload_id_unique", "unique": True}),
+    ("uploads", [("expires_at", 1)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}),
+    ("tryons", [("id", 1)], {"name": "id_unique", "unique": True}),
+    ("tryons", [("feedback.feedback_timestamp", -1), ("id", -1)], {
+        "name": "feedback_timestamp_id",
+        "partialFilterExpression": {"feedback": {"$exists": True}}
+    }),
+    ("tryons", [("feedback.serial_number", -1)], {
+        "name": "feedback_serial_number",
+        "partialFilterExpression": {"feedback": {"$exists": True}}
+    }),
+    ("tryons", [("mode", 1), ("status", 1), ("timestamp", 1)], {
+        "name": "job_status_timestamp",
+        "partialFilterExpression": {"mode": "job"}
+    }),
+    ("tryons", [("timestamp", 1)], {"name": "timestamp_asc"}),
+    ("status_checks", [("timestamp", -1)], {"name": "timestamp_desc"}),
+    ("webhook_outbox", [("id", 1)], {"name": "id_unique", "unique": True}),
+    ("webhook_outbox", [("status", 1), ("next_attempt_at", 1)], {"name": "status_next_attempt"}),
+    ("webhook_outbox", [("status", 1), ("created_at", 1)], {"name": "status_created_at"}),
+    ("image_variants", [("source_ref", 1), ("variant", 1)], {"name": "source_ref_variant_unique", "unique": True}),
+]
+
+# Result of the last ensure_indexes run, keyed by collection
+index_report = {}
+
+
+async def ensure_indexes() -> dict:
+    """
+    Create every declared index and report, per collection, which are missing or not declared here
+    """
+    report = {}
+    for collection_name, keys, options in REQUIRED_INDEXES:
+        entry = report.setdefault(collection_name, {"declared": [], "failed": {}})
+        entry["declared"].append(options["name"])
+        try:
+            await db[collection_name].create_index(keys, **options)
+        except OperationFailure as e:
+            # Typically duplicate values for a unique index, or an existing index with other options
+            entry["failed"][options["name"]] = str(e)
+            logger.error(f"Failed to create index {collection_name}.{options['name']}: {e}")
+    
+    for collection_name, entry in report.items():
+        existing = await db[collection_name].index_information()
+        entry["missing"] = [name for name in entry["declared"] if name not in existing]
+        entry["undeclared"] = [name for name in existing if name != "_id_" and name not in entry["declared"]]
+        if entry["missing"]:
+            logger.error(f"Missing indexes on {collection_name}: {', '.join(entry['missing'])}")
+        if entry["undeclared"]:
+            logger.warning(f"Indexes on {collection_name} not declared in REQUIRED_INDEXES: {', '.join(entry['undeclared'])}")
+    
+    index_report.clear()
+    index_report.update(report)
+    return report
+
+
+async def collect_index_usage(collection_name: str) -> dict:
+    """
+    Operations served by each index since the server last restarted ($indexStats)
+    """
+    try:
+        stats = await db[collection_name].aggregate([{"$indexStats": {}}]).to_list(None)
+    except OperationFailure as e:
+        logger.warning(f"Index usage not available for {collection_name}: {e}")
+        return {}
+    return {
+        stat["name"]: {"ops": stat["accesses"]["ops"], "since": stat["accesses"]["since"]}
+        for stat in stats
+    }
+
+
+@api_router.get("/db/indexes")
+async def get_index_report():
+    """
+    Get declared, missing, undeclared and unused indexes for every collection with declared indexes
+    """
+    try:
+        collections = {}
+        for collection_name, entry in index_report.items():
+            usage = await collect_index_usage(collection_name)
+            collections[collection_name] = {
+                **entry,
+                "usage": usage,
+                "unused": [name for name, stat in usage.items() if name != "_id_" and stat["ops"] == 0]
+            }
+        return {"collections": collections}
+    except Exception as e:
+        logger.error(f"Error building index report: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def thread_pool_queue_depth() -> int:
+    """
+    Calls waiting for a thread in the default executor used by asyncio.to_thread (blob and file I/O)
+    """
+    executor = getattr(asyncio.get_running_loop(), "_default_executor", None)
+    work_queue = getattr(executor, "_work_queue", None)
+    return work_queue.qsize() if work_queue is not None else 0
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """
+    Prometheus text exposition of request, try-on stage and capacity metrics
+    """
+    slot_stats = gemini_pool.stats() if gemini_pool else []
+    webhook_backlog = {
+        status: await db.webhook_outbox.count_documents({"status": status})
+        for status in ("pending", "sending")
+    }
+    
+    lines = [
+        *http_requests_total.render(),
+        *http_request_duration_seconds.render(),
+        *tryon_stage_duration_seconds.render(),
+        *render_gauge(
+            "gemini_generations_in_flight", "Gemini generations currently running",
+            sum(stats["in_flight"] for stats in slot_stats)
+        ),
+        *render_gauge(
+            "gemini_generations_waiting", "Gemini generations waiting for a per-key concurrency slot",
+            sum(stats["waiting"] for stats in slot_stats)
+        ),
+        *render_gauge(
+            "gemini_admission_running", "Generations holding a global admission slot", generation_admission.running
+        ),
+        *render_gauge(
+            "gemini_admission_queue_depth", "Generations waiting for a global admission slot", generation_admission.queued
+        ),
+        *gemini_admission_rejections_total.render(),
+        *render_gauge("thread_pool_queue_depth", "Calls queued for the default thread pool", thread_pool_queue_depth()),
+        *render_gauge(
+            "image_process_pool_pending", "Image jobs submitted to the process pool and not finished",
+            image_process_stats["pending"]
+        ),
+        *render_gauge(
+            "cpu_executor_pending", "Base64 jobs submitted to the CPU executor and not finished",
+            cpu_executor_stats["pending"]
+        ),
+        *render_gauge("tryon_job_queue_depth", "Queued try-on jobs waiting for a worker", tryon_job_queue.qsize()),
+        "# HELP webhook_outbox_backlog Webhook deliveries not yet delivered or dead-lettered",
+        "# TYPE webhook_outbox_backlog gauge",
+        *[
+            f"webhook_outbox_backlog{format_metric_labels(('status',), (status,))} {count}"
+            for status, count in webhook_backlog.items()
+        ],
+        *render_gauge(
+            "tryon_generations_in_flight", "Distinct try-on generations running, each shared by identical requests",
+            len(tryon_generations_in_flight)
+        ),
+        *render_gauge(
+            "tryon_result_cache_bytes", "Bytes held by the try-on result cache", tryon_result_cache.currsize
+        )
+    ]
+    return Response(content="\n".join(lines) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(RequestBodyLimitMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Tryon-Id", "X-Tryon-Timestamp", "X-Tryon-Status", "X-Tryon-Cached", "Content-Location", "Retry-After"],
 )
 
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # Label by route template, not the raw path, so ids do not explode the series count
+        route = request.scope.get("route")
+        route_path = getattr(route, "path", "unmatched")
+        http_requests_total.inc(method=request.method, route=route_path, status=status_code)
+        http_request_duration_seconds.observe(time.perf_counter() - start, method=request.method, route=route_path)
+
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    trace = {"start": time.perf_counter(), "spans": []}
+    token = request_trace.set(trace)
+    profile_key = slow_request_profiler.begin() if slow_request_profiler is not None else None
+    status_code = 500
+    response = None
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        request_trace.reset(token)
+        total = time.perf_counter() - trace["start"]
+        samples = slow_request_profiler.end(profile_key) if profile_key is not None else None
+        
+        route = request.scope.get("route")
+        if response is not None:
+            response.headers["Server-Timing"] = format_server_timing(trace["spans"], total)
+        
+        if trace["spans"] or samples:
+            record = {
+                "timestamp": datetime.utcnow().isoformat(),
+                "method": request.method,
+                "path": request.url.path,
+                "route": getattr(route, "path", "unmatched"),
+                "status": status_code,
+                "duration_ms": round(total * 1000, 1),
+                "spans": [
+                    {"name": name, "start_ms": round(offset * 1000, 1), "duration_ms": round(duration * 1000, 1)}
+                    for name, offset, duration in trace["spans"]
+                ]
+            }
+            logger.info(f"Trace: {json.dumps(record)}")
+            
+            if samples and total >= TRACE_SLOW_REQUEST_SECONDS:
+                record["profile"] = {
+                    "interval_ms": TRACE_PROFILE_INTERVAL_SECONDS * 1000,
+                    "samples": sum(samples.values()),
+                    "stacks": [
+                        {"stack": stack, "count": count}
+                        for stack, count in samples.most_common(TRACE_PROFILE_MAX_STACKS)
+                    ]
+                }
+                try:
+                    await asyncio.to_thread(append_trace_record, record)
+                    logger.warning(f"Slow request {request.method} {request.url.path} took {total:.1f}s, profile written to {TRACE_FILE}")
+                except Exception as e:
+                    logger.error(f"Failed to write slow request trace: {e}")
+    return response
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -604,6 +3700,110 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def provision_indexes():
+    report = await ensure_indexes()
+    declared = sum(len(entry["declared"]) for entry in report.values())
+    missing = sum(len(entry["missing"]) for entry in report.values())
+    logger.info(f"Index check complete: {declared} declared, {missing} missing")
+
+@app.on_event("startup")
+async def start_gemini_pool():
+    global gemini_pool
+    api_keys = load_gemini_api_keys()
+    if not api_keys:
+        logger.error("GEMINI_API_KEY not found in environment")
+    gemini_pool = GeminiClientPool(api_keys)
+    logger.info(f"Started Gemini client pool with {len(api_keys)} key(s)")
+    # Warm up in the background so a slow Gemini endpoint never delays startup
+    start_background_task(gemini_pool.warm_up(GEMINI_IMAGE_MODEL))
+
+@app.on_event("startup")
+async def start_image_process_pool():
+    global image_process_pool
+    image_process_pool = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS)
+    logger.info(f"Started image process pool with {IMAGE_PROCESS_WORKERS} workers")
+
+@app.on_event("startup")
+async def start_cpu_executor():
+    global cpu_executor
+    cpu_executor = ThreadPoolExecutor(max_workers=CPU_EXECUTOR_WORKERS, thread_name_prefix="cpu")
+    logger.info(f"Started CPU executor with {CPU_EXECUTOR_WORKERS} threads")
+
+@app.on_event("startup")
+async def start_tryon_job_workers():
+    # Jobs left running by a previous process never finished; run them again
+    await db.tryons.update_many(
+        {"mode": "job", "status": "running"},
+        {"$set": {"status": "queued"}}
+    )
+    async for job in db.tryons.find({"mode": "job", "status": "queued"}, {"id": 1, "_id": 0}).sort("timestamp", 1):
+        tryon_job_queue.put_nowait(job["id"])
+    
+    for worker_index in range(TRYON_JOB_WORKERS):
+        tryon_job_worker_tasks.append(asyncio.create_task(tryon_job_worker(worker_index)))
+    logger.info(f"Started {TRYON_JOB_WORKERS} try-on job workers ({tryon_job_queue.qsize()} jobs pending)")
+
+@app.on_event("startup")
+async def seed_feedback_serial_counter():
+    await backfill_feedback_serial_counter()
+
+@app.on_event("startup")
+async def seed_feedback_rollups():
+    await backfill_feedback_rollups()
+
+@app.on_event("startup")
+async def start_webhook_dispatcher():
+    global webhook_dispatcher_task
+    if N8N_WEBHOOK_PAYLOAD_MODE == "reference":
+        if not PUBLIC_BASE_URL:
+            logger.warning("N8N_WEBHOOK_PAYLOAD_MODE is 'reference' but PUBLIC_BASE_URL is not set, image URLs will be relative")
+        if not os.environ.get("IMAGE_URL_SIGNING_SECRET"):
+            logger.warning("IMAGE_URL_SIGNING_SECRET is not set, signed image URLs stop working after a restart")
+    get_webhook_http_client()
+    webhook_dispatcher_task = asyncio.create_task(webhook_dispatcher())
+    logger.info(f"Started n8n webhook dispatcher (concurrency {WEBHOOK_DISPATCH_CONCURRENCY})")
+
+@app.on_event("startup")
+async def start_retention():
+    global retention_task
+    # Uploads from before retention existed get the same lifetime, counted from their upload time
+    if UPLOAD_RETENTION_HOURS > 0:
+        await db.uploads.update_many(
+            {"expires_at": {"$exists": False}},
+            [{"$set": {"expires_at": {"$add": ["$timestamp", int(UPLOAD_RETENTION_HOURS * 3600 * 1000)]}}}]
+        )
+    retention_task = asyncio.create_task(retention_loop())
+    logger.info(f"Retention: uploads expire after {UPLOAD_RETENTION_HOURS}h, try-ons archived after {TRYON_ARCHIVE_AFTER_DAYS or 'never'} days")
+
+@app.on_event("startup")
+async def start_slow_request_profiler():
+    global slow_request_profiler
+    if TRACE_SLOW_REQUEST_SECONDS > 0:
+        slow_request_profiler = SlowRequestProfiler(TRACE_SLOW_REQUEST_SECONDS, TRACE_PROFILE_INTERVAL_SECONDS)
+        slow_request_profiler.start()
+        logger.info(f"Profiling requests slower than {TRACE_SLOW_REQUEST_SECONDS}s into {TRACE_FILE}")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in tryon_job_worker_tasks:
+        task.cancel()
+    if image_process_pool is not None:
+        image_process_pool.shutdown(wait=False, cancel_futures=True)
+    if cpu_executor is not None:
+        cpu_executor.shutdown(wait=False, cancel_futures=True)
+    # Stops the Gemini warm-up if it is still running
+    await stop_background_tasks(background_tasks)
+    if gemini_pool is not None:
+        await gemini_pool.close()
+    if webhook_dispatcher_task is not None:
+        webhook_dispatcher_task.cancel()
+    if retention_task is not None:
+        retention_task.cancel()
+    # Let deliveries in flight finish before their HTTP client goes away
+    await stop_background_tasks(webhook_delivery_tasks, timeout=WEBHOOK_SHUTDOWN_GRACE_SECONDS)
+    if webhook_http_client is not None:
+        await webhook_http_client.aclose()
+    if slow_request_profiler is not None:
+        slow_request_profiler.stop()
     client.close()
@@ -1,4 +1,7 @@
 const CACHE_NAME = 'tryon-app-v1-network-first';
+// Try-on and upload images are immutable per URL, so they are served cache-first
+const IMAGE_CACHE_NAME = 'tryon-images-v1';
+const IMAGE_URL_PATTERN = /\/api\/(tryon|upload)\/[^/]+\/image(\?|$)/;
 const urlsToCache = [
   '/',
   '/index.html',
@@ -20,6 +23,25 @@ self.addEventListener('install', event => {
 });
 
 self.addEventListener('fetch', event => {
+  if (event.request.method === 'GET' && IMAGE_URL_PATTERN.test(event.request.url)) {
+    event.respondWith(
+      caches.open(IMAGE_CACHE_NAME).then(cache =>
+        cache.match(event.request).then(cached => {
+          if (cached) {
+            return cached;
+          }
+          return fetch(event.request).then(response => {
+            if (response && response.status === 200) {
+              cache.put(event.request, response.clone());
+            }
+            return response;
+          });
+        })
+      )
+    );
+    return;
+  }
+
   // Network First Strategy
   // 1. Try to get from network (latest version)
   // 2. If network fails (offline), get from cache
@@ -45,7 +67,7 @@ self.addEventListener('fetch', event => {
 });
 
 self.addEventListener('activate', event => {
-  const cacheWhitelist = [CACHE_NAME];
+  const cacheWhitelist = [CACHE_NAME, IMAGE_CACHE_NAME];
   event.waitUntil(
     caches.keys().then(cacheNames => {
       return Promise.all(
@@ -4,6 +4,10 @@ import '../styles/FeedbackViewer.css';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
+const PAGE_SIZE = 20;
+
+// Thumbnail URLs are relative unless the backend has PUBLIC_BASE_URL configured
+const imageSrc = (url) => (url.startsWith('http') ? url : `${BACKEND_URL}${url}`);
 
 const FeedbackViewer = ({ onClose }) => {
   const [feedback, setFeedback] = useState([]);
@@ -13,39 +17,75 @@ const FeedbackViewer = ({ onClose }) => {
   const [dailyStats, setDailyStats] = useState([]);
   const [selectedDate, setSelectedDate] = useState('all');
   const [showDailyStats, setShowDailyStats] = useState(false);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   useEffect(() => {
     loadFeedback();
-  }, []);
+    loadAnalytics();
+  }, [selectedDate]);
 
-  const loadFeedback = async () => {
+  // Exact totals and per-day counts come from the server-side rollups, not the loaded page
+  const loadAnalytics = async () => {
     try {
-      setLoading(true);
-      const response = await axios.get(`${API}/feedback/all`);
-      setFeedback(response.data.feedback);
-      setDailyStats(response.data.daily_stats || []);
+      const params = {};
+      if (selectedDate !== 'all') {
+        params.start_date = selectedDate;
+        params.end_date = selectedDate;
+      }
+      const response = await axios.get(`${API}/feedback/analytics`, { params });
+      const analytics = response.data;
       
-      // Calculate statistics
-      if (response.data.feedback.length > 0) {
-        const ratings = response.data.feedback.map(f => f.rating);
-        const avgRating = (ratings.reduce((a, b) => a + b, 0) / ratings.length).toFixed(1);
-        const ratingCounts = [1, 2, 3, 4, 5].map(star => 
-          ratings.filter(r => r === star).length
-        );
-        
+      if (analytics.total > 0) {
         setStats({
-          total: response.data.total,
-          average: avgRating,
-          distribution: ratingCounts
+          total: analytics.total,
+          average: analytics.average_rating.toFixed(1),
+          distribution: [1, 2, 3, 4, 5].map(star => analytics.rating_distribution[star] || 0)
         });
+      } else {
+        setStats(null);
+      }
+      
+      // Keep the date options of the unfiltered range while a date is selected
+      if (selectedDate === 'all') {
+        setDailyStats(
+          analytics.daily
+            .map(day => ({ date: day.date, count: day.total }))
+            .reverse()
+        );
+      }
+    } catch (err) {
+      console.error('Error loading feedback analytics:', err);
+    }
+  };
+
+  const loadFeedback = async (cursor = null) => {
+    try {
+      if (cursor) {
+        setLoadingMore(true);
+      } else {
+        setLoading(true);
       }
       
+      // Paginated, image-free listing; the date filter is applied on the server
+      const params = { limit: PAGE_SIZE };
+      if (cursor) params.cursor = cursor;
+      if (selectedDate !== 'all') {
+        params.start_date = selectedDate;
+        params.end_date = selectedDate;
+      }
+      const response = await axios.get(`${API}/feedback`, { params });
+      const items = cursor ? [...feedback, ...response.data.feedback] : response.data.feedback;
+      setFeedback(items);
+      setNextCursor(response.data.next_cursor);
+      
       setError(null);
     } catch (err) {
       console.error('Error loading feedback:', err);
       setError('Failed to load feedback');
     } finally {
       setLoading(false);
+      setLoadingMore(false);
     }
   };
 
@@ -177,20 +217,19 @@ const FeedbackViewer = ({ onClose }) => {
 
             {/* Feedback List */}
             <div className="feedback-list">
-              {feedback
-                .filter(item => selectedDate === 'all' || item.feedback_date === selectedDate)
-                .map((item, index) => (
-                <div key={index} className="feedback-item-card">
+              {feedback.map((item, index) => (
+                <div key={item.tryon_id || index} className="feedback-item-card">
                   <div className="feedback-serial-badge">
                     #{item.serial_number || 'N/A'}
                   </div>
                   
                   {/* Image First - Most Prominent */}
-                  {item.result_image && (
+                  {item.thumbnail_url && (
                     <div className="feedback-image-main">
                       <img 
-                        src={`data:image/png;base64,${item.result_image}`} 
+                        src={imageSrc(item.thumbnail_url)} 
                         alt="Try-on result" 
+                        loading="lazy"
                       />
                     </div>
                   )}
@@ -226,6 +265,16 @@ const FeedbackViewer = ({ onClose }) => {
                 </div>
               ))}
             </div>
+
+            {nextCursor && (
+              <button 
+                className="stats-toggle-button"
+                onClick={() => loadFeedback(nextCursor)}
+                disabled={loadingMore}
+              >
+                {loadingMore ? 'Loading...' : 'Load more'}
+              </button>
+            )}
           </>
         )}
       </div>
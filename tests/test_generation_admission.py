@@ -0,0 +1,72 @@
+"""
+Admission control for Gemini generations (GenerationAdmission in backend/server.py)
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+# Placeholder MongoDB settings so server.py can be imported; admission control needs no database
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_generation_admission")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+async def hold_slot(admission, seconds: float, bounded: bool = True):
+    try:
+        async with admission.slot(bounded=bounded):
+            await asyncio.sleep(seconds)
+        return 200
+    except HTTPException as he:
+        assert "Retry-After" in he.headers
+        return he.status_code
+
+
+def run_burst(admission, count: int, seconds: float, bounded: bool = True) -> list:
+    async def burst():
+        # All calls start in the same event loop tick
+        return await asyncio.gather(*[hold_slot(admission, seconds, bounded) for _ in range(count)])
+    return asyncio.run(burst())
+
+
+def test_same_tick_burst_is_bounded():
+    admission = server.GenerationAdmission(max_concurrent=1, max_queued=1, queue_timeout=5)
+    results = run_burst(admission, 10, 0.05)
+    
+    assert sorted(results) == [200, 200] + [429] * 8
+    assert admission.rejected == {"queue_full": 8}
+    assert admission.running == 0 and admission.queued == 0
+
+
+def test_queue_deadline_rejects_with_503():
+    admission = server.GenerationAdmission(max_concurrent=1, max_queued=2, queue_timeout=0.05)
+    results = run_burst(admission, 3, 0.3)
+    
+    assert sorted(results) == [200, 503, 503]
+    assert admission.rejected == {"queue_timeout": 2}
+
+
+def test_unbounded_callers_wait_instead_of_being_rejected():
+    admission = server.GenerationAdmission(max_concurrent=1, max_queued=0, queue_timeout=0.01)
+    results = run_burst(admission, 4, 0.02, bounded=False)
+    
+    assert results == [200] * 4
+    assert admission.admitted == 4
+
+
+def test_retry_after_grows_with_backlog():
+    admission = server.GenerationAdmission(max_concurrent=2, max_queued=10, queue_timeout=5)
+    admission.average_seconds = 4.0
+    assert admission.retry_after() == 4
+    admission.running, admission.queued = 2, 6
+    assert admission.retry_after() == 16
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,130 @@
+"""
+Shared try-on generations (generate_tryon_result in backend/server.py) and their cancellation
+"""
+
+import asyncio
+import base64
+import hashlib
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+# Placeholder database settings for server.py's import; generations cancelled here never reach the insert
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_tryon_coalescing")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+class FakeGeminiPool:
+    """
+    Stands in for GeminiPool: every generation blocks until released, recording how it ended
+    """
+    
+    def __init__(self):
+        self.slots = [None]
+        self.started = 0
+        self.cancelled = 0
+        self.finished = 0
+        self.release = asyncio.Event()
+    
+    async def generate_content(self, **kwargs):
+        self.started += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        self.finished += 1
+        return SimpleNamespace(parts=[SimpleNamespace(inline_data=SimpleNamespace(data=b"result"))])
+
+
+def fake_image(name: str) -> tuple:
+    image_bytes = name.encode()
+    return image_bytes, {
+        "mime_type": "image/png",
+        "width": 10,
+        "height": 10,
+        "aspect_ratio": "1:1",
+        "sha256": hashlib.sha256(image_bytes).hexdigest()
+    }
+
+
+def fake_upload(name: str) -> dict:
+    image_bytes, image_meta = fake_image(name)
+    return {"upload_id": name, "image_data": base64.b64encode(image_bytes).decode(), "image_meta": image_meta}
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakeGeminiPool()
+    monkeypatch.setattr(server, "gemini_pool", pool)
+    monkeypatch.setattr(server, "generation_admission", server.GenerationAdmission(
+        max_concurrent=4, max_queued=10, queue_timeout=5
+    ))
+    server.tryon_result_cache.clear()
+    return pool
+
+
+async def wait_until(condition):
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not reached")
+
+
+def test_cancelled_batch_stops_its_generations(pool):
+    async def batch():
+        semaphore = asyncio.Semaphore(2)
+        person_image = fake_image("person")
+        # Same tasks as stream_results in create_tryon_batch
+        tasks = [
+            asyncio.create_task(server.run_tryon_batch_item(
+                index, fake_upload(f"garment-{index}"), person_image, semaphore, False
+            ))
+            for index in range(4)
+        ]
+        await wait_until(lambda: pool.started == 2)
+        
+        # The client disconnects mid-batch
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await wait_until(lambda: pool.cancelled == 2)
+    
+    asyncio.run(batch())
+    
+    assert pool.started == 2
+    assert pool.finished == 0
+    assert server.tryon_generations_in_flight == {}
+    assert server.tryon_generation_waiters == {}
+
+
+def test_shared_generation_survives_one_waiter_leaving(pool):
+    person_image, clothing_image = fake_image("person"), fake_image("garment")
+    
+    async def double_tap():
+        first = asyncio.create_task(server.generate_tryon_result(person_image, [clothing_image]))
+        second = asyncio.create_task(server.generate_tryon_result(person_image, [clothing_image]))
+        await wait_until(lambda: pool.started == 1)
+        await asyncio.sleep(0.01)
+        
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        assert pool.cancelled == 0
+        
+        pool.release.set()
+        return await second
+    
+    assert asyncio.run(double_tap()) == (b"result", True)
+    assert pool.started == 1 and pool.finished == 1
+    assert server.tryon_generation_waiters == {}
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))